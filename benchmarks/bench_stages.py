@@ -0,0 +1,171 @@
+# Stage-level benchmark of zone generation and the localised analysis on a synthetic cohort
+import os,sys,json,time,argparse,tempfile,platform,subprocess,contextlib,io
+import numpy as np
+import pandas as pd
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+from benchmarks.gen_synthetic_cohort import gen_synthetic_cohort
+
+@contextlib.contextmanager
+def timed(stages, name):
+    """Adds the wall time of the block to stages[name], in seconds."""
+    start = time.perf_counter()
+    yield
+    stages[name] = stages.get(name, 0.) + time.perf_counter() - start
+
+
+def git_commit():
+    """Commit of the benchmarked tree, None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stages(levels, zone_configs, sampling_mode, num_workers, out_dir):
+    """
+    Times every pipeline stage on the cohort under the PROMIS_ROOT environment variable.
+
+    Stages run one after another over all levels and zone configurations, each on the outputs
+    of the previous ones, so every timing covers only its own stage.
+
+    Returns:
+        tuple: Stage timings in seconds and the sizes of the benchmarked grid.
+    """
+    # config.py reads PROMIS_ROOT on import
+    import gen_localised_zones as gz
+    import localised_analysis as la
+    la.sampling_mode = sampling_mode
+    # time full stages, without skipping the patients the manifests record as unchanged
+    gz.manifest_dir = la.manifest_dir = None
+    stages = {}
+
+    with timed(stages, 'zone_generation'), contextlib.redirect_stdout(io.StringIO()):
+        gz.generate_localised_zones_multi(zone_configs, levels, la.nii_dir, num_workers)
+
+    patient_ids = la.load_patient_ids()
+    with timed(stages, 'report_loading'):
+        mri_dicts = la.load_mri_reports(patient_ids)
+
+    with timed(stages, 'rule_evaluation'):
+        tpm_cancer, tpm_zone_wc = la.get_tpm_cancer_tensor(patient_ids, la.total_cancer_defs, la.load_rules())
+    patient_index = {pid: p for p, pid in enumerate(patient_ids)}
+    # the grid stages time the first reader
+    reader, (lesion_file, _) = next(iter(la.readers.items()))
+
+    grid = {'num_patients': len(patient_ids), 'levels': levels, 'zone_configs': zone_configs,
+            'num_cells': 0, 'num_ci_iter': la.num_ci_iter, 'sample_times': la.sample_times, 'sampling_mode': sampling_mode}
+    log_dicts = []
+    for level in levels:
+        num_zones, _, tpm_zone_map_config = la.get_level_config(level)
+        for zone_config in zone_configs:
+            # the first pass decodes the NIfTI files into the volume cache
+            for name in ['mask_loading_cold', 'mask_loading']:
+                with timed(stages, name):
+                    volumes = {pid: (la.load_localised_volume(pid, zone_config, level), la.load_localised_volume(pid, zone_config), la.load_mri_lesion_sparse(pid, lesion_file))
+                               for pid in patient_ids}
+
+            with timed(stages, 'iou'):
+                for zone_volume, zone_volume_20, lesions in volumes.values():
+                    if zone_volume is not None and lesions is not None:
+                        la.iou_from_counts(la.sparse_overlap_counts(lesions, zone_volume, num_zones))
+                    if zone_volume is not None and level != 20:
+                        la.calculate_overlap_counts_cropped(zone_volume_20, zone_volume, num_zones)
+
+            with timed(stages, 'feature_extraction'), contextlib.redirect_stdout(io.StringIO()):
+                patient_features = {pid: la.extract_patient_features(pid, zone_config, level, num_zones, mri_dicts, tpm_zone_map_config) for pid in patient_ids}
+                patient_features = {pid: features for pid, features in patient_features.items() if features is not None}
+
+            with timed(stages, 'sampling'):
+                for pid, features in patient_features.items():
+                    if features["tpm"] is None:
+                        continue
+                    map_prob = la.get_zone_map_probabilities(level, num_zones, tpm_zone_map_config, features["quarter_ratio_dict"], tpm_cancer.shape[1])
+                    cancer_zones = {cancer_def: [zone for zone in tpm_zone_wc[pid] if tpm_cancer[patient_index[pid], zone - 1, d] == 1]
+                                    for d, cancer_def in enumerate(la.total_cancer_defs)}
+                    features["tpm_zones"] = la.get_tpm_zones(pid, cancer_zones, map_prob, level, num_zones)
+
+            exact_counts = sampling_mode == 'exact' and level != 20
+            for pirads_thre in la.pirads_thresholds:
+                for iou_thre in la.iou_thresholds:
+                    for cancer_def in la.total_cancer_defs:
+                        grid['num_cells'] += 1
+                        with timed(stages, 'confusion_matrix'):
+                            mri_rows = [la.get_mri_zones(features["readers"][reader], pirads_thre, iou_thre) for features in patient_features.values()]
+                            tpm_groups = [features["tpm_zones"][cancer_def] for features in patient_features.values() if features["tpm"] is not None]
+                            if len(tpm_groups) != len(mri_rows):
+                                continue
+                            mri_np, tpm_np, row_index = la.compact_rows(mri_rows, tpm_groups)
+                            if exact_counts:
+                                contributions = la.cm_contributions(tpm_np, mri_np)[row_index] * la.sample_times
+                                TP, TN, FP, FN = contributions.sum(axis=0)
+                            else:
+                                TP, TN, FP, FN = la.calculate_cm(tpm_np, mri_np, np.bincount(row_index))
+                            sensitivity, specificity, PPV, NPV = la.calculate_performance_metrics(TP, TN, FP, FN)
+
+                        with timed(stages, 'bootstrap'):
+                            if exact_counts:
+                                cis = la.bootstrap_ci_from_contributions(contributions, la.sample_times)
+                            else:
+                                cis = la.bootstrap_confidence_intervals(mri_np, tpm_np, row_index=row_index)
+                        log_dict = {"definition": cancer_def, "pirads_thre": pirads_thre, "iou_thre": iou_thre,
+                                    "TP": TP, "FP": FP, "FN": FN, "TN": TN,
+                                    "sensitivity": sensitivity, "specificity": specificity, "PPV": PPV, "NPV": NPV}
+                        log_dict.update(zip(['sensitivity_ci', 'specificity_ci', 'PPV_ci', 'NPV_ci'], cis))
+                        log_dicts.append(la.format_log_dict(log_dict))
+
+    with timed(stages, 'excel_export'):
+        pd.DataFrame(log_dicts).to_excel(os.path.join(out_dir, 'bench_multiiou.xlsx'), index=False)
+    return stages, grid
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on a synthetic cohort and append the results to a JSON file")
+    parser.add_argument('--root-dir', help="Existing cohort to benchmark, a synthetic one is generated in a temporary directory by default")
+    parser.add_argument('--num-patients', type=int, default=50)
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 24])
+    parser.add_argument('--lesion-density', type=float, default=1.5)
+    parser.add_argument('--levels', type=int, nargs='+', default=[20, 8, 4, 2])
+    parser.add_argument('--zone-configs', nargs='+', default=['set1'])
+    parser.add_argument('--sampling-mode', choices=['sample', 'exact'], default='sample')
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--output', default=os.path.join(repo_dir, 'benchmarks', 'results.json'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = args.root_dir
+        cohort = {'root_dir': root_dir}
+        if root_dir is None:
+            root_dir = os.path.join(tmp_dir, 'promis')
+            start = time.perf_counter()
+            gen_synthetic_cohort(root_dir, args.num_patients, tuple(args.shape), args.lesion_density)
+            cohort = {'num_patients': args.num_patients, 'shape': args.shape, 'lesion_density': args.lesion_density,
+                      'generation_seconds': time.perf_counter() - start}
+        os.environ['PROMIS_ROOT'] = root_dir
+        # rules.yml and zone_config.yml are read from the working directory
+        os.chdir(repo_dir)
+        stages, grid = run_stages(args.levels, args.zone_configs, args.sampling_mode, args.num_workers, tmp_dir)
+
+    record = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'num_workers': args.num_workers,
+        'cohort': cohort,
+        'grid': grid,
+        'stages': stages,
+        'total_seconds': sum(stages.values()),
+    }
+    results = []
+    if os.path.exists(args.output):
+        with open(args.output, 'r') as f:
+            results = json.load(f)
+    results.append(record)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name, seconds in stages.items():
+        print(f"{name:>20}: {seconds:8.3f} s")
+    print(f"Appended results to {args.output}")
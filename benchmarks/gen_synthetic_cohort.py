@@ -0,0 +1,93 @@
+# Synthetic PROMIS-like cohort in the on-disk layout of the dataset download
+import os,argparse
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+def ellipsoid(shape, centre, radii):
+    """Boolean mask of an axis-aligned ellipsoid."""
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    return sum(((g - c) / r) ** 2 for g, c, r in zip(grid, centre, radii)) <= 1
+
+
+def gen_patient(rng, shape, lesion_density, max_lesions=5):
+    """
+    Generates the volumes and report entries of one synthetic patient.
+
+    Returns:
+        tuple: (gland, lesion, pirads, tpm) with the gland mask, the lesion label volume (None
+            without lesions), the PI-RADS score of every lesion label and the TPM table.
+    """
+    shape = np.array(shape)
+    centre = shape / 2 + rng.uniform(-0.05, 0.05, 3) * shape
+    radii = shape * rng.uniform(0.25, 0.35, 3)
+    gland = ellipsoid(shape, centre, radii)
+
+    num_lesions = min(rng.poisson(lesion_density), max_lesions)
+    lesion = np.zeros(shape, dtype=np.uint8)
+    gland_voxels = np.argwhere(gland)
+    for label in range(1, num_lesions + 1):
+        lesion_centre = gland_voxels[rng.integers(len(gland_voxels))]
+        lesion[ellipsoid(shape, lesion_centre, radii * rng.uniform(0.1, 0.25, 3)) & gland & (lesion == 0)] = label
+    pirads = rng.integers(2, 6, num_lesions).astype(float)
+
+    present = rng.random(20) < 0.3
+    grade = lambda: np.where(present, rng.integers(3, 6, 20), np.nan)
+    tpm = pd.DataFrame({
+        'zone_id': np.arange(1, 21),
+        'zprescancer': present.astype(float),
+        'zprimgleason': grade(),
+        'zsecondgleason': grade(),
+        'maxccuk': np.where(present, rng.integers(1, 15, 20), np.nan),
+        'maxccus': np.where(present, rng.integers(1, 15, 20), np.nan),
+    })
+    return gland, (lesion if num_lesions > 0 else None), pirads, tpm
+
+
+def gen_synthetic_cohort(root_dir, num_patients=50, shape=(128, 128, 24), lesion_density=1.5, missing_tpm_fraction=0., seed=0):
+    """
+    Writes a synthetic cohort under root_dir in the layout config.py expects.
+
+    That is MRI/P-*/{t2,gland,lesion_a1}.nii.gz, the MRI report spreadsheet with one les_all row
+    per lesion label, and one template biopsy CSV per patient in Cleaned_Spreadsheets.
+
+    Args:
+        shape (tuple): Volume shape in voxels.
+        lesion_density (float): Mean number of lesions per patient (Poisson).
+        missing_tpm_fraction (float): Fraction of patients without a template biopsy CSV.
+    """
+    rng = np.random.default_rng(seed)
+    nii_dir = os.path.join(root_dir, 'MRI')
+    tpm_report_dir = os.path.join(root_dir, 'Cleaned_Spreadsheets', 'Template_biopsy')
+    os.makedirs(tpm_report_dir, exist_ok=True)
+    affine = np.diag([0.5, 0.5, 3., 1.])
+
+    report_rows = []
+    for i in range(num_patients):
+        pid = f'P-{10000000 + i}'
+        os.makedirs(os.path.join(nii_dir, pid), exist_ok=True)
+        gland, lesion, pirads, tpm = gen_patient(rng, shape, lesion_density)
+
+        t2 = (rng.random(shape) * 500 + gland * 300).astype(np.int16)
+        nib.save(nib.Nifti1Image(t2, affine), os.path.join(nii_dir, pid, 't2.nii.gz'))
+        nib.save(nib.Nifti1Image(gland.astype(np.uint8), affine), os.path.join(nii_dir, pid, 'gland.nii.gz'))
+        if lesion is not None:
+            nib.save(nib.Nifti1Image(lesion, affine), os.path.join(nii_dir, pid, 'lesion_a1.nii.gz'))
+
+        report_rows += [{'patientID': pid, 'les_all': score} for score in pirads] or [{'patientID': pid, 'les_all': np.nan}]
+        if rng.random() >= missing_tpm_fraction:
+            tpm.to_csv(os.path.join(tpm_report_dir, f'{pid}.csv'), index=False)
+
+    pd.DataFrame(report_rows).to_excel(os.path.join(root_dir, 'Cleaned_Spreadsheets', 'PROMIS_OA_MRI_cleaned.xlsx'), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic PROMIS-like cohort, use it with PROMIS_ROOT=<root_dir>")
+    parser.add_argument('root_dir')
+    parser.add_argument('--num-patients', type=int, default=50)
+    parser.add_argument('--shape', type=int, nargs=3, default=[128, 128, 24])
+    parser.add_argument('--lesion-density', type=float, default=1.5)
+    parser.add_argument('--missing-tpm-fraction', type=float, default=0.)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    gen_synthetic_cohort(args.root_dir, args.num_patients, tuple(args.shape), args.lesion_density, args.missing_tpm_fraction, args.seed)
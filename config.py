@@ -1,14 +1,66 @@
 import numpy as np
 import os
 
-root_dir = '/Users/wangyipei/Library/CloudStorage/OneDrive-UniversityCollegeLondon/promis'
+# Dataset root, override with the PROMIS_ROOT environment variable (e.g. for a synthetic cohort)
+root_dir = os.environ.get('PROMIS_ROOT', '/Users/wangyipei/Library/CloudStorage/OneDrive-UniversityCollegeLondon/promis')
 nii_dir = os.path.join(root_dir,'MRI') # image directory
 mri_report_dir = os.path.join(root_dir, 'Cleaned_Spreadsheets', 'PROMIS_OA_MRI_cleaned.xlsx') # MRI report directory
 tpm_report_dir = os.path.join(root_dir, 'Cleaned_Spreadsheets', 'Template_biopsy') # TPM report directory
 
+# Uncompressed, memory-mapped cache of decoded label volumes (None to always decode the NIfTI files)
+volume_cache_dir = os.path.join(root_dir, 'cache', 'volumes')
+
+# Indexed MRI report and TPM tables, rebuilt when a source spreadsheet changes (None to parse them on every run)
+report_cache_file = os.path.join(root_dir, 'cache', 'reports.pkl')
+
+# Per-patient features of each level and zone configuration, memory-mapped by the analysis sweep workers
+sweep_feature_dir = os.path.join(root_dir, 'cache', 'features')
+
+# Per-patient manifests of input fingerprints (T2, masks, reports, zone configuration and code), zone generation
+# and feature extraction only rerun for the patients whose inputs changed (None reruns every patient)
+manifest_dir = os.path.join(root_dir, 'cache', 'manifests')
+
+# SQLite store committing every analysis row as it is computed, reruns skip the rows already
+# computed from the same inputs and code (None keeps the rows in memory for this run only).
+# Kept with the other caches, so runs from any working directory and on any node share it
+results_db = os.path.join(root_dir, 'cache', 'results.sqlite')
+export_excel = True # write the *_multiiou.xlsx tables from the store at the end of each level
+patient_level_analysis = True # also compute the patient-level accuracy (*_patient.xlsx) from the same patient pass
+
+# Zone mask files written by gen_localised_zones.py, the analysis reads any of these formats
+zone_mask_label_header = True # store labels as uint8 (False keeps the data type and scaling of the T2 header)
+zone_mask_compresslevel = 1 # gzip level (1-9) of .nii.gz files, 0 writes uncompressed .nii files
+zone_mask_combined = False # one 4D gland_zone_<set> file holding every level of a zone configuration
+
 # Excluded Patient IDs
 excluded_pids = ['P-14794814', 'P-81927032', 'P-50311284', 'P-53294571', 'P-31906541']
 
+# Chrome trace JSON with per-stage timings, bytes read, rise of the process peak RSS during a stage and skip counts, written at the end of a run (None disables tracing)
+trace_file = None
+
+# Number of worker processes for per-patient jobs and analysis sweep tasks (1 runs serially for debugging)
+num_workers = 1
+
+# Serial patient loops load the next patients and save zone masks on background threads
+prefetch_depth = 2 # patients loaded ahead of the one being processed (0 loads and saves serially)
+stream_max_volumes = 8 # hard cap on volumes held in memory, loaded ahead or waiting to be saved
+stream_threads = 2 # background loading and saving threads
+
+# Work queue on shared storage: with queue_dir set, zone generation and the analysis sweep write their tasks
+# there and run them together with any queue_worker.py processes started on nodes sharing the directory,
+# instead of local worker processes (None). The data, cache and working directories must have the same paths on every node.
+queue_dir = None
+queue_shard_size = 8 # patients or grid cells per task
+queue_heartbeat_seconds = 10 # a worker touches the claim of its running task this often
+queue_stale_seconds = 120 # claims untouched for this long are from dead workers and run again
+
+# Lesion annotation sources evaluated in one patient pass, sharing the zone masks and TPM ground truth:
+# reader name -> (lesion mask file in each patient directory, MRI report column of its lesion PI-RADS scores).
+# With several readers every output row starts with its reader.
+readers = {
+    'a1': ('lesion_a1.nii.gz', 'les_all'),
+}
+
 # Rules configuration
 ccl_flag = 'uk'
 rules_file = 'rules.yml'
@@ -17,9 +69,33 @@ total_cancer_defs = ['def1', 'def2', 'gs>=7']
 
 # Confidence Interval Calculation
 num_ci_iter = 100 # Number of bootstrap iterations for CI
+# 'compat' redraws the seed-42 indices of the original per-iteration loop, 'multinomial' draws
+# the weights of unique rows directly (faster for many samples, different draws)
+bootstrap_mode = 'compat'
+# 'row' resamples the zone rows of the patients, one row per patient and sampled draw at the 8/4/2 levels
+# ('exact' counts each patient as sample_times rows of its expected counts), 'patient' resamples whole patients
+bootstrap_unit = 'row'
+bootstrap_chunk_elements = 2**22 # drawn indices or weights held in memory per chunk of replicates
 
 # Sampling
 sample_times = 100 
+# How split Barzell zones are mapped onto 8/4/2 zones:
+# 'legacy' draws with the random module as published, 'sample' draws with one numpy Generator
+# stream per patient, 'exact' computes the expected TP/TN/FP/FN without sampling
+sampling_mode = 'legacy'
+sampling_seed = 42
+
+# ROC curves over continuous IoU and PI-RADS thresholds (roc_analysis.py)
+roc_fpr_points = 101 # false positive rates from 0 to 1 the bootstrap sensitivity bands are given at
+
+# In-memory zone configuration sweep (zone_config_sweep.py): every combination of these
+# zone_config.yml parameter values is tried on top of the base configuration
+zone_sweep_base_config = 'set1'
+zone_sweep_grid = {
+    'apex': [0.4, 0.5, 0.6],
+    'left-right': [0.1, 0.15, 0.2],
+    'anterior-cutoff': [0.5, 0.6],
+}
 
 # Zone mappings from barzell zones to octant, quadrant, and hemi zones
 # octant zone definitions
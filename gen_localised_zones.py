@@ -1,8 +1,34 @@
-import yaml,os,tqdm
+import yaml,os,json,gzip,tqdm,traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from utils.zone_utils import *
-from config import nii_dir
+from config import nii_dir, num_workers, manifest_dir, zone_mask_label_header, zone_mask_compresslevel, zone_mask_combined, queue_dir, queue_shard_size
+from utils.trace_utils import span, count_event, flush_events, write_trace
+from utils.stream_utils import PatientStream
+from utils.queue_utils import run_queued
+from utils.cache_utils import source_hash, input_fingerprint, file_fingerprint, atomic_save, zone_mask_path, zone_mask_extensions, find_zone_mask
 import nibabel as nib
 
+zone_coor_funcs = {
+    20: config2coor_barzell,
+    8: config2coor_8level,
+    4: config2coor_4level,
+    2: config2coor_2level,
+}
+
+# sources whose changes regenerate every zone mask
+zone_code_files = [os.path.abspath(__file__), os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils', 'zone_utils.py')]
+
+# output format of the zone masks, a change regenerates every zone mask
+zone_output = {'label_header': zone_mask_label_header, 'compresslevel': zone_mask_compresslevel, 'combined': zone_mask_combined}
+zone_mask_extension = '.nii.gz' if zone_mask_compresslevel > 0 else '.nii'
+
+def get_zone_lim(config, localised_level, bbox):
+    """Get zone limits based on the localised level."""
+    if localised_level not in zone_coor_funcs:
+        raise ValueError(f"Unsupported localised level: {localised_level}")
+    return zone_coor_funcs[localised_level](config, *bbox)
+
 def generate_localised_zones(zone_config_name, localised_level, nii_dir):
     patient_list = os.listdir(nii_dir)
     # cnt = 0
@@ -27,27 +53,314 @@ def generate_localised_zones(zone_config_name, localised_level, nii_dir):
         # get gland bbox limits
         x_min, x_max, y_min, y_max, z_min, z_max = bbox_range(t2_arr, gland_mask_arr)
         # get zone limits based on the localised level
-        if localised_level == 20:
-            zone_lim = config2coor_barzell(zone_config[zone_config_name], x_min, x_max, y_min, y_max, z_min, z_max)
-        elif localised_level == 8:
-            zone_lim = config2coor_8level(zone_config[zone_config_name], x_min, x_max, y_min, y_max, z_min, z_max)
-        elif localised_level == 4:
-            zone_lim = config2coor_4level(zone_config[zone_config_name], x_min, x_max, y_min, y_max, z_min, z_max)
-        elif localised_level == 2:
-            zone_lim = config2coor_2level(zone_config[zone_config_name], x_min, x_max, y_min, y_max, z_min, z_max)
-        else:
-            raise ValueError(f"Unsupported localised level: {localised_level}")
-        zone_mask = gen_zone_on_mask(gland_mask_arr, zone_lim, z_min, z_max)
+        zone_lim = get_zone_lim(zone_config[zone_config_name], localised_level, (x_min, x_max, y_min, y_max, z_min, z_max))
+        zone_mask = gen_zone_on_mask_fast(gland_mask_arr, zone_lim, z_min, z_max)
         zone_mask = zone_mask.astype('uint8')
-        zone_mask_nii = nib.Nifti1Image(zone_mask, t2_img.affine, t2_img.header)
-        nib.save(zone_mask_nii, os.path.join(nii_dir, pid, f'gland_zone_{localised_level}level_{zone_config_name}.nii.gz'))
+        zone_mask_nii = zone_mask_image(zone_mask, t2_img)
+        save_zone_mask(zone_mask_nii, zone_mask_path(nii_dir, pid, zone_config_name, localised_level, zone_mask_extension), pid)
         # cnt += 1
         # if cnt == 2:
         #     break
 
+def load_patient(pid, nii_dir):
+    """
+    Loads the T2 image header and the gland mask of one patient.
+
+    Returns:
+        tuple: (t2_img, gland_mask_arr, skip_reason), with None volumes and the reason when the patient
+            is skipped, or an exception instead of the tuple when loading fails.
+    """
+    try:
+        t2_dir = os.path.join(nii_dir, pid, 't2.nii.gz')
+        if not os.path.exists(t2_dir):
+            return None, None, 'T2 image does not exist'
+        t2_img = nib.load(t2_dir)
+
+        gland_mask_dir = os.path.join(nii_dir, pid, f'gland.nii.gz')
+        if not os.path.exists(gland_mask_dir):
+            return None, None, 'gland mask does not exist'
+        with span('load_gland', pid=pid):
+            gland_mask_arr = nib.load(gland_mask_dir).get_fdata()
+        return t2_img, gland_mask_arr, None
+    except Exception as e:
+        return e
+
+def zone_mask_image(zone_mask, t2_img, levels=None):
+    """
+    NIfTI image of a zone mask on the T2 image grid, with a uint8 data type unless zone_mask_label_header
+    is False, which keeps the data type and scaling of the T2 header.
+
+    Args:
+        levels (list): Levels of a 4D zone_mask stacking every level, recorded in the header description.
+    """
+    header = t2_img.header.copy()
+    if zone_mask_label_header:
+        header.set_data_dtype(np.uint8)
+    if levels is not None:
+        header['descrip'] = 'levels=' + ','.join(str(level) for level in levels)
+    return nib.Nifti1Image(zone_mask, t2_img.affine, header)
+
+def write_zone_mask(zone_mask_nii, file_path, f):
+    """
+    Writes the bytes of a zone mask NIfTI file to f, gzipped at zone_mask_compresslevel for .nii.gz files.
+    The gzip header holds no time or file name, so the same zone mask always gives the same bytes, as nib.save.
+    """
+    if file_path.endswith('.gz'):
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=zone_mask_compresslevel, fileobj=f, mtime=0) as gz:
+            gz.write(zone_mask_nii.to_bytes())
+    else:
+        f.write(zone_mask_nii.to_bytes())
+
+def save_zone_mask(zone_mask_nii, file_path, pid):
+    """
+    Writes one zone mask NIfTI file through atomic_save, so a worker killed midway or a queue task
+    run twice never leaves a truncated zone mask.
+    """
+    with span('save_zones', pid=pid):
+        atomic_save(lambda f: write_zone_mask(zone_mask_nii, file_path, f), file_path)
+
+def process_patient(pid, zone_config_names, localised_levels, nii_dir, zone_config, loaded=None, save=save_zone_mask, pending=None):
+    """
+    Generates every requested level and zone configuration from a single load of one patient.
+
+    The T2 image is only opened for its header, and the Barzell zones are labelled once
+    and reused for the Barzell level and the Barzell x level count tables.
+    With zone_mask_combined every level of a zone configuration is written to one 4D file,
+    so all of them are generated when any is pending.
+
+    Args:
+        loaded: Result of load_patient when the patient was loaded ahead, None to load it here.
+        save (callable): save_zone_mask or a replacement writing in the background.
+        pending (set): (zone_config_name, localised_level) pairs to generate, None for all of them.
+
+    Returns:
+        dict: Per-patient result with 'pid', 'status' ('done', 'skipped' or 'failed'),
+            'reason', 'traceback', the list of written 'files' and the 'sidecars' of the
+            generated zone masks per zone configuration, see save_zone_sidecar.
+    """
+    result = {'pid': pid, 'status': 'done', 'reason': None, 'traceback': None, 'files': [], 'sidecars': {}}
+    try:
+        if loaded is None:
+            loaded = load_patient(pid, nii_dir)
+        if isinstance(loaded, Exception):
+            raise loaded
+        t2_img, gland_mask_arr, skip_reason = loaded
+        if skip_reason is not None:
+            result.update(status='skipped', reason=skip_reason)
+            return result
+
+        assert t2_img.shape == gland_mask_arr.shape, "the shapes of img and seg are not equal"
+        bbox = bbox_range(gland_mask_arr, gland_mask_arr)
+        z_min, z_max = bbox[4], bbox[5]
+
+        # Barzell zones go first, also in the level order of combined zone mask files
+        localised_levels = sorted(localised_levels, key=lambda level: level != 20)
+        for zone_config_name in zone_config_names:
+            levels = [level for level in localised_levels if pending is None or (zone_config_name, level) in pending]
+            if not levels:
+                continue
+            if zone_mask_combined:
+                levels = localised_levels
+            # the Barzell zones are labelled even when not saved, for the Barzell x level count tables
+            barzell_lim = get_zone_lim(zone_config[zone_config_name], 20, bbox)
+            barzell_mask = gen_zone_on_mask_fast(gland_mask_arr, barzell_lim, z_min, z_max).astype('uint8')
+            sidecar = {'bbox': [int(v) for v in bbox], 'shape': list(gland_mask_arr.shape), 'levels': {}}
+            zone_masks = []
+            for localised_level in levels:
+                zone_lim = get_zone_lim(zone_config[zone_config_name], localised_level, bbox)
+                if localised_level == 20:
+                    zone_mask = barzell_mask
+                else:
+                    zone_mask = gen_zone_on_mask_fast(gland_mask_arr, zone_lim, z_min, z_max).astype('uint8')
+                if zone_mask_combined:
+                    zone_masks.append(zone_mask)
+                else:
+                    file_path = zone_mask_path(nii_dir, pid, zone_config_name, localised_level, zone_mask_extension)
+                    save(zone_mask_image(zone_mask, t2_img), file_path, pid)
+                    result['files'].append(os.path.basename(file_path))
+
+                counts = zone_count_table(barzell_mask, zone_mask, bbox, len(barzell_lim) - 1, len(zone_lim) - 1)
+                entry = {'zone_counts': counts.sum(axis=0).tolist()}
+                if localised_level != 20:
+                    entry['barzell_counts'] = counts.tolist()
+                sidecar['levels'][str(localised_level)] = entry
+            if zone_mask_combined:
+                file_path = zone_mask_path(nii_dir, pid, zone_config_name, None, zone_mask_extension)
+                save(zone_mask_image(np.stack(zone_masks, axis=3), t2_img, levels), file_path, pid)
+                result['files'].append(os.path.basename(file_path))
+            result['sidecars'][zone_config_name] = sidecar
+    except Exception as e:
+        result.update(status='failed', reason=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+    return result
+
+def run_patient(pid, *args, **kwargs):
+    """process_patient in a per-patient trace span, skipped and failed patients are counted as trace events."""
+    with span('zone_generation', pid=pid):
+        result = process_patient(pid, *args, **kwargs)
+    if result['status'] != 'done':
+        count_event(f"{result['status']}_patient", pid=pid, reason=result['reason'])
+    flush_events()
+    return result
+
+def generate_localised_zones_stream(patient_list, args, pending):
+    """
+    Serial run_patient over a PatientStream, the next patients are loaded and the zone masks
+    saved on background threads. A patient whose zone mask fails to save is reported as failed.
+    """
+    summary, saves = [], {}
+    with PatientStream() as stream:
+        for pid, loaded in tqdm.tqdm(stream.stream(patient_list, lambda pid: load_patient(pid, args[2])), total=len(patient_list)):
+            saves[pid] = []
+            def save(zone_mask_nii, file_path, pid):
+                saves[pid].append(stream.save(save_zone_mask, zone_mask_nii, file_path, pid))
+            summary.append(run_patient(pid, *args, loaded=loaded, save=save, pending=pending[pid]))
+    for result in summary:
+        errors = [future.exception() for future in saves[result['pid']] if future.exception() is not None]
+        if errors and result['status'] == 'done':
+            e = errors[0]
+            result.update(status='failed', reason=f"{type(e).__name__}: {e}", traceback=''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+            count_event('failed_patient', pid=result['pid'], reason=result['reason'])
+    return summary
+
+def zone_inputs(pid, nii_dir, config, code):
+    """Manifest entry of the inputs a zone mask of one patient and zone configuration is generated from."""
+    return input_fingerprint([os.path.join(nii_dir, pid, 't2.nii.gz'), os.path.join(nii_dir, pid, 'gland.nii.gz')], zone_config=config, code=code, output=zone_output)
+
+def zone_manifest_path(pid):
+    return os.path.join(manifest_dir, 'zones', f'{pid}.json')
+
+def pending_zones(pid, zone_config_names, localised_levels, nii_dir, zone_config, code):
+    """
+    Finds the zone masks of one patient that need generating, from its manifest.
+
+    Returns:
+        set: (zone_config_name, localised_level) pairs whose zone mask is missing, was generated
+            from other inputs or has been modified since, None for all of them without manifests.
+    """
+    if manifest_dir is None or not os.path.exists(zone_manifest_path(pid)):
+        return None
+    with open(zone_manifest_path(pid), 'r') as f:
+        manifest = json.load(f)
+    pending = set()
+    for zone_config_name in zone_config_names:
+        inputs = zone_inputs(pid, nii_dir, zone_config[zone_config_name], code)
+        for localised_level in localised_levels:
+            entry = manifest.get(zone_config_name, {}).get(str(localised_level))
+            found = find_zone_mask(nii_dir, pid, zone_config_name, localised_level)
+            if entry is None or found is None or entry['inputs'] != inputs or entry['output'] != input_fingerprint([found[0]]):
+                pending.add((zone_config_name, localised_level))
+    return pending
+
+def save_zone_manifest(result, zone_config_names, localised_levels, nii_dir, zone_config, code):
+    """Records the inputs and written file of every zone mask generated for a patient."""
+    pid = result['pid']
+    manifest = {}
+    if os.path.exists(zone_manifest_path(pid)):
+        with open(zone_manifest_path(pid), 'r') as f:
+            manifest = json.load(f)
+    for zone_config_name, sidecar in result['sidecars'].items():
+        inputs = zone_inputs(pid, nii_dir, zone_config[zone_config_name], code)
+        for level in sidecar['levels']:
+            file_path = find_zone_mask(nii_dir, pid, zone_config_name, int(level))[0]
+            manifest.setdefault(zone_config_name, {})[level] = {'inputs': inputs, 'output': input_fingerprint([file_path])}
+    os.makedirs(os.path.dirname(zone_manifest_path(pid)), exist_ok=True)
+    atomic_save(lambda f: json.dump(manifest, f, indent=1), zone_manifest_path(pid), 'w')
+
+def zone_sidecar_path(nii_dir, pid, zone_config_name):
+    return os.path.join(nii_dir, pid, f'gland_zone_{zone_config_name}.json')
+
+def remove_superseded_zone_masks(result, nii_dir):
+    """Removes the zone masks of the generated levels left from a run with another output format."""
+    pid = result['pid']
+    written = {os.path.join(nii_dir, pid, file_name) for file_name in result['files']}
+    for zone_config_name, sidecar in result['sidecars'].items():
+        superseded = [zone_mask_path(nii_dir, pid, zone_config_name, int(level), extension) for level in sidecar['levels'] for extension in zone_mask_extensions]
+        if zone_mask_combined:
+            superseded += [zone_mask_path(nii_dir, pid, zone_config_name, None, extension) for extension in zone_mask_extensions]
+        for file_path in superseded:
+            if file_path not in written and os.path.exists(file_path):
+                os.remove(file_path)
+
+def save_zone_sidecar(result, localised_levels, nii_dir):
+    """
+    Writes the sidecar of every zone configuration generated for a patient, once its zone masks are saved.
+
+    The sidecar holds the gland bounding box and, per level, the voxel count of every zone and the
+    Barzell x level count table the analysis computes its split-zone ratios from, with the fingerprints
+    of the zone masks they describe. Levels generated in an earlier run are kept.
+    """
+    pid = result['pid']
+    for zone_config_name, sidecar in result['sidecars'].items():
+        sidecar_path = zone_sidecar_path(nii_dir, pid, zone_config_name)
+        levels = {}
+        if os.path.exists(sidecar_path):
+            with open(sidecar_path, 'r') as f:
+                levels = json.load(f)['levels']
+        # the Barzell mask the tables were counted on, when it is the file on disk
+        barzell = find_zone_mask(nii_dir, pid, zone_config_name, 20) if 20 in localised_levels else None
+        for level, entry in sidecar['levels'].items():
+            entry['mask'] = file_fingerprint(find_zone_mask(nii_dir, pid, zone_config_name, int(level))[0])
+            if 'barzell_counts' in entry:
+                entry['barzell_mask'] = file_fingerprint(barzell[0]) if barzell is not None else None
+            levels[level] = entry
+        atomic_save(lambda f: json.dump(dict(sidecar, levels=levels), f), sidecar_path, 'w')
+
+def generate_localised_zones_multi(zone_config_names, localised_levels, nii_dir, num_workers=num_workers):
+    """
+    Generates every requested level and zone configuration, one whole patient per task.
+
+    Only the zone masks whose inputs (T2 image, gland mask, zone configuration, code and output format) changed
+    since the manifest of the patient was written are generated, see pending_zones. The zone
+    counts of the generated masks are written to a sidecar per patient, see save_zone_sidecar.
+
+    Args:
+        num_workers (int): Number of worker processes. 1 runs in this process, streamed
+            through background loading and saving (serially with prefetch_depth 0 for debugging).
+            Ignored with queue_dir set, shards of queue_shard_size patients are then run by
+            this process and the queue workers.
+
+    Returns:
+        list: Per-patient results from process_patient, sorted by patient ID, with status
+            'unchanged' for the patients that had nothing to generate.
+    """
+    with open('zone_config.yml', 'r') as f:
+        zone_config = yaml.safe_load(f)
+    args = (zone_config_names, localised_levels, nii_dir, zone_config)
+    code = source_hash(zone_code_files)
+    pending = {pid: pending_zones(pid, *args, code) for pid in sorted(os.listdir(nii_dir))}
+    patient_list = [pid for pid in pending if pending[pid] != set()]
+
+    summary = [{'pid': pid, 'status': 'unchanged', 'reason': None, 'traceback': None, 'files': [], 'sidecars': {}} for pid in pending if pending[pid] == set()]
+    if queue_dir is not None:
+        shards = [patient_list[i:i + queue_shard_size] for i in range(0, len(patient_list), queue_shard_size)]
+        for shard_summary in tqdm.tqdm(run_queued('gen_localised_zones', 'generate_localised_zones_stream', [(shard, args, {pid: pending[pid] for pid in shard}) for shard in shards]), total=len(shards)):
+            summary += shard_summary
+    elif num_workers <= 1:
+        summary += generate_localised_zones_stream(patient_list, args, pending)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(run_patient, pid, *args, pending=pending[pid]) for pid in patient_list]
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+                summary.append(future.result())
+    for result in summary:
+        if result['status'] == 'done':
+            remove_superseded_zone_masks(result, nii_dir)
+            save_zone_sidecar(result, localised_levels, nii_dir)
+            if manifest_dir is not None:
+                save_zone_manifest(result, *args, code)
+    return sorted(summary, key=lambda res: res['pid'])
+
+def print_summary(summary):
+    """Prints the skip and failure report of a zone generation run."""
+    by_status = {status: [res for res in summary if res['status'] == status] for status in ['done', 'unchanged', 'skipped', 'failed']}
+    print(f"Done: {len(by_status['done'])}, unchanged: {len(by_status['unchanged'])}, skipped: {len(by_status['skipped'])}, failed: {len(by_status['failed'])}")
+    for res in by_status['skipped'] + by_status['failed']:
+        print(f"    {res['status'].capitalize()} {res['pid']}: {res['reason']}")
+
 if __name__ == "__main__":
-    zone_config_name = 'set1'  # zone configuration name, choose from 'set1', 'set2', or define your own
-    # localised_level = 2  # localised level (20 for Barzell zones)
-    for localised_level in [20, 8, 4, 2]:
-        print(f"Generating localised zones for level {localised_level} with configuration {zone_config_name}")
-        generate_localised_zones(zone_config_name, localised_level, nii_dir)
\ No newline at end of file
+    zone_config_names = ['set1', ]  # zone configuration names, choose from 'set1', 'set2', or define your own
+    localised_levels = [20, 8, 4, 2]  # localised levels (20 for Barzell zones)
+    print(f"Generating localised zones for levels {localised_levels} with configurations {zone_config_names}")
+    summary = generate_localised_zones_multi(zone_config_names, localised_levels, nii_dir, num_workers)
+    print_summary(summary)
+    write_trace()
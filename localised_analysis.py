@@ -3,9 +3,20 @@ import pandas as pd
 import numpy as np
 import tqdm
 import random
+import zlib
+import io,os,contextlib,functools
+from concurrent.futures import ProcessPoolExecutor
 from utils.stat_utils import *
+from utils.trace_utils import span, traced, count_event, flush_events, write_trace
+from utils.stream_utils import PatientStream
+from utils.results_utils import results_key, patient_level_key, open_results_store, store_row, stored_cells, export_results_excel
+from utils.cache_utils import source_hash, input_fingerprint, load_patient_cache, save_patient_cache
+from utils.queue_utils import run_queued
 from config import *
 
+# sources whose changes extract the features of every patient again
+feature_code_files = [os.path.abspath(__file__)] + [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils', file_name) for file_name in ['stat_utils.py', 'cache_utils.py']]
+
 # Helper function to calculate ratio of intersection for multi-level zones
 def calculate_ratio(multi_zone_dict, big_zone_mask, bar_zone_mask, ratio_dict):
     """Calculates the ratio of intersection between combined zones and their corresponding barzell zones."""
@@ -15,22 +26,174 @@ def calculate_ratio(multi_zone_dict, big_zone_mask, bar_zone_mask, ratio_dict):
             ratio = intersection / np.sum(bar_zone_mask == bar_zone)
             ratio_dict[bar_zone][zone] = ratio  
     return ratio_dict
-    
 
-def run_analysis_for_localised_level(localised_level: int):
+
+def calculate_ratio_from_counts(multi_zone_dict, zone_counts, ratio_dict):
+    """calculate_ratio from a barzell x combined zone voxel count table."""
+    for bar_zone, big_zone in multi_zone_dict.items():
+        bar_zone_counts = zone_counts[bar_zone] if bar_zone < zone_counts.shape[0] else np.zeros(zone_counts.shape[1], dtype=np.intp)
+        for zone in big_zone:
+            ratio_dict[bar_zone][zone] = bar_zone_counts[zone] / bar_zone_counts.sum()
+    return ratio_dict
+
+
+def load_patient_inputs(pid, zone_config, localised_level):
     """
-    Runs the analysis for a specified zone level (2, 4, 8, or 20).
+    Loads the zone masks, the sparse lesion voxels of every reader and TPM data one patient's features are extracted from.
+
+    The label volumes are read into memory, so a patient loaded ahead by a PatientStream is not
+    read again from the volume cache while its features are extracted. The Barzell zone mask of
+    a coarse level is only loaded when its zone sidecar is missing or out of date.
+
+    Returns:
+        dict: Cropped zone volumes, the Barzell x level count table, sparse lesions and TPM data, None for missing files.
+    """
+    read = lambda volume: volume if volume is None or not isinstance(volume[0], np.memmap) else (np.array(volume[0]), volume[1], volume[2])
+    zone_volume = read(load_localised_volume(pid, zone_config, localised_level))
+    zone_counts_20 = load_zone_counts(pid, zone_config, localised_level) if localised_level != 20 else None
+    return {
+        "zone_volume": zone_volume,
+        "zone_volume_20": zone_volume if localised_level == 20 else None if zone_counts_20 is not None else read(load_localised_volume(pid, zone_config, )),
+        "zone_counts_20": zone_counts_20,
+        "mri_lesions": {reader: load_mri_lesion_sparse(pid, lesion_file) for reader, (lesion_file, _) in readers.items()},
+        "tpm": load_tpm_data(pid),
+    }
+
+
+def extract_patient_features(pid, zone_config, localised_level, num_zones, mri_dicts, tpm_zone_map_config, inputs=None):
+    """
+    Loads the volumes and reports of one patient once and extracts what the threshold grid needs.
 
     Args:
-        localised_level (int): The zone level to perform analysis for (2, 4, 8, or 20).
+        mri_dicts (dict): load_mri_report of every reader.
+        inputs (dict): load_patient_inputs of the patient when it was loaded ahead, None to load it here.
+
+    Returns:
+        dict: Per reader the lesion x zone overlap counts and IoU and the lesion PI-RADS scores from the
+            MRI report, the TPM data and the split-zone ratios. None if the zone masks are missing.
+            Skipped patients are counted as trace events and reported by extract_all_features.
     """
-    print(f"\n--- Running Analysis for {localised_level}-Zone Level ---")
-    random.seed(42) # Ensure reproducibility
+    if inputs is None:
+        inputs = load_patient_inputs(pid, zone_config, localised_level)
+    # Zone masks (current level and 20 barzell zones or their count table for calculating ratios)
+    zone_volume, zone_volume_20, zone_counts = inputs["zone_volume"], inputs["zone_volume_20"], inputs["zone_counts_20"]
+    if zone_volume is None or (zone_volume_20 is None and zone_counts is None):
+        return None
 
-    patient_ids = load_patient_ids()
-    mri_dict = load_mri_report(patient_ids)
-    rules = load_rules()
+    # Process MRI Lesions of every reader against the same zone masks, looking up the zones at the lesion voxels
+    reader_features = {}
+    zone_label_counts = np.bincount(np.asarray(zone_volume[0]).astype(np.intp).ravel(), minlength=1)
+    for reader, mri_lesions in inputs["mri_lesions"].items():
+        if mri_lesions is None:
+            mri_lesions = (np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.intp), zone_volume[2])
+        overlap_counts = sparse_overlap_counts(mri_lesions, zone_volume, num_zones, zone_label_counts)
+        reader_features[reader] = {
+            "overlap_counts": overlap_counts,
+            "iou": iou_from_counts(overlap_counts)[:, :num_zones],
+            "pirads": np.array(mri_dicts[reader][pid], dtype=float),
+        }
+
+    features = {
+        "readers": reader_features,
+        "tpm": inputs["tpm"],
+        "half_ratio_dict": {},
+        "quarter_ratio_dict": {},
+    }
+    if features["tpm"] is None:
+        return features
+
+    # Calculate ratios for 4/8 zone if applicable (used for probabilistic mapping), counted by the zone sidecar when up to date
+    if localised_level in [2, 4, 8]:
+        if zone_counts is None:
+            zone_counts = calculate_overlap_counts_cropped(zone_volume_20, zone_volume, num_zones)
+        half_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["half_map"].items()}
+        features["half_ratio_dict"] = calculate_ratio_from_counts(tpm_zone_map_config["half_map"], zone_counts, half_ratio_dict)
+    if localised_level == 8:
+        quarter_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["quarter_map"].items()}
+        features["quarter_ratio_dict"] = calculate_ratio_from_counts(tpm_zone_map_config["quarter_map"], zone_counts, quarter_ratio_dict)
+    return features
+
+
+def get_zone_map_probabilities(localised_level, num_zones, tpm_zone_map_config, quarter_ratio_dict, num_bar_zones=20):
+    """
+    Calculates the probability of each Barzell zone being mapped onto each zone of the current level.
+
+    Split zones follow the legacy draws: a uniform choice for half zones, and for quarter zones the
+    searchsorted lookup of a uniform number in the cumulative ratios (NaN ratios sort last).
+
+    Returns:
+        np.ndarray: Probabilities of shape (num_bar_zones+1, num_zones), row 0 unused.
+    """
+    map_prob = np.zeros((num_bar_zones + 1, num_zones))
+    for zone_id_20 in range(1, num_bar_zones + 1):
+        if localised_level == 20:
+            map_prob[zone_id_20, zone_id_20 - 1] = 1
+        elif zone_id_20 in tpm_zone_map_config["half_map"]:
+            for zone in tpm_zone_map_config["half_map"][zone_id_20]:
+                map_prob[zone_id_20, zone - 1] += 1 / len(tpm_zone_map_config["half_map"][zone_id_20])
+        elif localised_level == 8 and zone_id_20 in tpm_zone_map_config["quarter_map"]:
+            q_zones = tpm_zone_map_config["quarter_map"][zone_id_20]
+            cumulative_ratios = np.cumsum([quarter_ratio_dict[zone_id_20][qz] for qz in q_zones])
+            edges = np.concatenate([[0], np.clip(np.nan_to_num(cumulative_ratios[:-1], nan=np.inf), 0, 1), [1]])
+            for zone, prob in zip(q_zones, np.diff(edges)):
+                map_prob[zone_id_20, zone - 1] += prob
+        elif tpm_zone_map_config["reverse_map"].get(zone_id_20) is not None:
+            map_prob[zone_id_20, tpm_zone_map_config["reverse_map"][zone_id_20] - 1] = 1
+    return map_prob
+
+
+@traced('sampling')
+def get_tpm_zones(pid, cancer_zones, map_prob, localised_level, num_zones):
+    """
+    Maps the cancer-positive Barzell zones of every definition onto the current level without the random module.
+
+    Returns:
+        dict: Rows of zone status per definition: a single binary row for 20 zones, sample_times
+            rows drawn from one numpy Generator stream per patient in 'sample' mode, or a single
+            row of zone cancer probabilities in 'exact' mode.
+    """
+    rng = np.random.default_rng([sampling_seed, zlib.crc32(pid.encode())])
+    tpm_zones = {}
+    for cancer_def, zones in cancer_zones.items():
+        if localised_level == 20:
+            tpm_zones[cancer_def] = map_prob[zones].max(axis=0, initial=0, keepdims=True)
+        elif sampling_mode == 'exact':
+            # a zone is positive unless every cancer zone is mapped elsewhere
+            tpm_zones[cancer_def] = 1 - np.prod(1 - map_prob[zones], axis=0, keepdims=True)
+        else:
+            tpm_zones[cancer_def] = np.zeros((sample_times, num_zones))
+            for zone_id_20 in zones:
+                if map_prob[zone_id_20].sum() > 0:
+                    mapped = rng.choice(num_zones, size=sample_times, p=map_prob[zone_id_20])
+                    tpm_zones[cancer_def][np.arange(sample_times), mapped] = 1
+    return tpm_zones
+
+
+def get_patient_tpm_zones(pid, features, localised_level, num_zones, tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index):
+    """get_tpm_zones for the cancer-positive Barzell zones of one patient, mapped with the ratios of its features."""
+    map_prob = get_zone_map_probabilities(localised_level, num_zones, tpm_zone_map_config, features["quarter_ratio_dict"], tpm_cancer.shape[1])
+    cancer_zones = {cancer_def: [zone for zone in tpm_zone_wc[pid] if tpm_cancer[patient_index[pid], zone - 1, d] == 1]
+                    for d, cancer_def in enumerate(total_cancer_defs)}
+    return get_tpm_zones(pid, cancer_zones, map_prob, localised_level, num_zones)
+
+
+def get_mri_zones(features, pirads_thre, iou_thre):
+    """Marks the zones overlapped, with IoU above iou_thre, by lesions scored at or above pirads_thre, from the features of one reader."""
+    iou = features["iou"]
+    pirads = features["pirads"][:iou.shape[0]]
+    # lesion labels without a report entry are kept, as the in-place relabelling used to do
+    keep = np.ones(iou.shape[0], dtype=bool)
+    keep[:len(pirads)] = pirads >= pirads_thre
+    return (iou[keep] > iou_thre).any(axis=0).astype(float)
+    
 
+def get_level_config(localised_level):
+    """
+    Zone count, output filename part and Barzell zone mappings of a zone level.
+
+    Returns:
+        tuple: (num_zones, zone_level_filename_part, tpm_zone_map_config), the mapping config is None for 20 zones.
+    """
     # --- Zone Level Specific Configurations ---
     num_zones = 20
     tpm_zone_map_config = None # Holds mapping dictionaries for 2, 4 or 8 zone
@@ -101,151 +264,558 @@ def run_analysis_for_localised_level(localised_level: int):
         }
     else:
         raise ValueError("Invalid localised_level. Must be 2, 4, 8, or 20.")
+    return num_zones, zone_level_filename_part, tpm_zone_map_config
 
-    for zone_config in current_zone_configs:
-        log_dict_array_for_current_file = []
 
-        for pirads_thre in pirads_thresholds:
-            for iou_thre in iou_thresholds:
-                print(f"Processing: Zone Config='{zone_config}', Pirads={pirads_thre}, IoU={iou_thre:.1e}")
-                
-                tpm_les_dict_all_patients = {k: [] for k in total_cancer_defs}
-                mri_les_all_patients = []
-
-                for pid in tqdm.tqdm(patient_ids, desc="    Patients"):
-                    # Load zone masks (current level and 20 barzell zones for calculating ratios)
-                    zone_arr_current_level = load_localised_mask(pid, zone_config, localised_level)
-                    zone_arr_20 = load_localised_mask(pid, zone_config, ) # Always needed for ratio calcs
-                    if zone_arr_current_level is None or zone_arr_20 is None:
-                        print(f"    Skipping patient {pid}: Missing zone mask files.")
-                        continue
-
-                    # Process MRI Lesions
-                    mri_les_arr = load_mri_lesion_mask(pid)
-                    if mri_les_arr is None:
-                        mri_les_arr = np.zeros_like(zone_arr_current_level)
-
-                    mri_les_cnt = 0
-                    for num,sig in enumerate(mri_dict[pid]):             
-                        if sig >= pirads_thre:
-                            mri_les_arr[mri_les_arr == num+1] = mri_les_cnt+1
-                            mri_les_cnt += 1
-                        else:
-                            mri_les_arr[mri_les_arr == num+1] = 0
-                    iou_results = calculate_iou_3d(mri_les_arr, zone_arr_current_level, iou_thre)
-                    mri_les_level_specific = np.zeros(num_zones)
-                    for _, zones_overlap in iou_results.items(): # iou_results maps lesion_label to list of overlapping zone_ids
-                        for zone_id in zones_overlap:
-                            mri_les_level_specific[zone_id - 1] = 1 # Mark zone as having an MRI lesion
-                    
-                    # Append MRI lesion status, applying sampling if relevant
-                    mri_les_all_patients.append(mri_les_level_specific)
-                    if localised_level in [2, 4, 8]:
-                        for _ in range(sample_times - 1):
-                            mri_les_all_patients.append(mri_les_level_specific)
-
-                    # Process TPM(template mapped biopsy) Data
-                    tpm = load_tpm_data(pid)
-                    if tpm is None:
-                        print(f"    Skipping patient {pid}: Missing TPM data.")
-                        continue
-                    
-                    # Calculate ratios for 4/8 zone if applicable (used for probabilistic mapping)
-                    half_ratio_dict = {}
-                    quarter_ratio_dict = {}
-                    if localised_level == 8:
-                        half_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["half_map"].items()}
-                        half_ratio_dict = calculate_ratio(tpm_zone_map_config["half_map"], zone_arr_current_level, zone_arr_20, half_ratio_dict)
-                        quarter_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["quarter_map"].items()}
-                        quarter_ratio_dict = calculate_ratio(tpm_zone_map_config["quarter_map"], zone_arr_current_level, zone_arr_20, quarter_ratio_dict)
-                    elif localised_level == 4 or localised_level == 2:
-                        half_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["half_map"].items()}
-                        half_ratio_dict = calculate_ratio(tpm_zone_map_config["half_map"], zone_arr_current_level, zone_arr_20, half_ratio_dict)
-
-                    # Apply cancer definitions to TPM data
-                    for cancer_def in total_cancer_defs:
-                        cancer_def_rules = rules['cancer_definition'][cancer_def]
-                        t_zone_wc_20_level, t_cancer_info_20_level = get_tpm_cancer_info(tpm, cancer_def_rules)
-                        curr_zone_wc_20_level = [zone for zone in t_zone_wc_20_level if t_cancer_info_20_level[zone] == '1']
-                        
-                        if localised_level == 20: # Direct mapping for 20-zone
-                            tpm_les_level_specific = np.zeros(num_zones)
-                            for zone_id_20 in curr_zone_wc_20_level:
-                                tpm_les_level_specific[zone_id_20 - 1] = 1
-                            tpm_les_dict_all_patients[cancer_def].append(tpm_les_level_specific)
-                        else: 
-                            for _ in range(sample_times):
-                                tpm_les_level_specific = np.zeros(num_zones)
-                                for zone_id_20 in curr_zone_wc_20_level:
-                                    if t_cancer_info_20_level[zone_id_20] == '1':
-                                        new_zone_id_mapped = None
-                                        if zone_id_20 in tpm_zone_map_config["half_map"]:
-                                            new_zone_id_mapped = random.choice(tpm_zone_map_config["half_map"][zone_id_20])
-                                        elif localised_level == 8 and zone_id_20 in tpm_zone_map_config["quarter_map"]: # for 8-zone quarter mapping only
-                                            rand_num = random.random()
-                                            q_zones = tpm_zone_map_config["quarter_map"][zone_id_20]
-                                            ordered_ratios = np.array([quarter_ratio_dict[zone_id_20][qz] for qz in q_zones])
-                                            cumulative_ratios = np.cumsum(ordered_ratios)
-                                            selected_zone_index = np.searchsorted(cumulative_ratios, rand_num, side='right')
-                                            if selected_zone_index == len(q_zones):
-                                                selected_zone_index -= 1
-                                            new_zone_id_mapped = q_zones[selected_zone_index]
-                                            # if new_zone_id_mapped is None and q_zones: # Fallback for edge cases with float precision
-                                            #     new_zone_id_mapped = q_zones[-1]
-                                        else: # Direct mapping from 20-zone to 2/4/8 zone
-                                            new_zone_id_mapped = tpm_zone_map_config["reverse_map"].get(zone_id_20)
-                                            
-                                        if new_zone_id_mapped is not None:
-                                            tpm_les_level_specific[new_zone_id_mapped - 1] = 1
-                                tpm_les_dict_all_patients[cancer_def].append(tpm_les_level_specific)
-                mri_les_all_patients_np = np.array(mri_les_all_patients)
+def patient_feature_inputs(pid, zone_config, localised_level, mri_dicts, code):
+    """
+    Manifest entry of the inputs the features of one patient are extracted from, see extract_all_features.
+    The Barzell zone mappings of the level are included, as they are set in config.py rather than in the code.
+    """
+    file_paths = [zone_mask_source(pid, zone_config, localised_level), zone_mask_source(pid, zone_config),
+                  os.path.join(tpm_report_dir, f'{pid.upper()}.csv')]
+    file_paths += [os.path.join(nii_dir, pid, lesion_file) for lesion_file, _ in readers.values()]
+    mri_reports = {reader: mri_dict[pid] for reader, mri_dict in mri_dicts.items()}
+    zone_map = get_level_config(localised_level)[2]
+    return input_fingerprint(file_paths, mri_reports=mri_reports, zone_map=zone_map, code=code)
+
+
+def load_patient_or_features(pid, zone_config, localised_level, mri_dicts, code, cache_dir):
+    """
+    Loader of the patient stream of extract_all_features.
+
+    Returns:
+        tuple: (inputs, hit, features), the features cached from the same inputs when hit is True,
+            otherwise load_patient_inputs to extract them from.
+    """
+    inputs = patient_feature_inputs(pid, zone_config, localised_level, mri_dicts, code)
+    hit, features = load_patient_cache(cache_dir, pid, inputs)
+    return inputs, hit, features if hit else load_patient_inputs(pid, zone_config, localised_level)
+
+
+def extract_all_features(localised_level, zone_config, patient_ids, mri_dicts, tpm_cancer, tpm_zone_wc):
+    """
+    Extracts the features of every patient with zone masks for one level and zone configuration.
+
+    Features are cached per patient under manifest_dir with the fingerprints of their inputs (zone
+    and reader lesion masks, TPM CSV, MRI report entries, Barzell zone mappings and code), so only new patients and patients
+    whose inputs changed are loaded again.
+    Outside 'legacy' sampling the mapped TPM zone rows of every definition are added as "tpm_zones".
+    Patients skipped for missing zone masks or TPM data are reported in one line per reason.
+
+    Returns:
+        dict: Features per patient ID, in patient order.
+    """
+    num_zones, _, tpm_zone_map_config = get_level_config(localised_level)
+    patient_index = {pid: p for p, pid in enumerate(patient_ids)}
+    cache_dir = os.path.join(manifest_dir, 'features', f"{localised_level}level_{zone_config}") if manifest_dir is not None else None
+    code = source_hash(feature_code_files)
+    patient_features = {}
+    skipped = {'missing zone mask files': [], 'missing TPM data': []}
+    num_cached = 0
+    with PatientStream() as stream:
+        patient_stream = stream.stream(patient_ids, lambda pid: load_patient_or_features(pid, zone_config, localised_level, mri_dicts, code, cache_dir),
+                                       num_volumes=2) # the zone masks, sparse lesions are not counted
+        for pid, (inputs, hit, loaded) in tqdm.tqdm(patient_stream, total=len(patient_ids), desc="    Patients"):
+            if hit:
+                features = loaded
+                num_cached += 1
+            else:
+                with span('extract_features', pid=pid):
+                    features = extract_patient_features(pid, zone_config, localised_level, num_zones, mri_dicts, tpm_zone_map_config, loaded)
+                save_patient_cache(cache_dir, pid, inputs, features)
+            if features is None:
+                skipped['missing zone mask files'].append(pid)
+                count_event('skip_patient', pid=pid, reason='missing zone mask files')
+            elif features["tpm"] is None:
+                skipped['missing TPM data'].append(pid)
+                count_event('skip_patient', pid=pid, reason='missing TPM data')
+            if features is not None:
+                patient_features[pid] = features
+            if features is not None and features["tpm"] is not None and sampling_mode != 'legacy':
+                features["tpm_zones"] = get_patient_tpm_zones(pid, features, localised_level, num_zones, tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index)
+    if num_cached:
+        print(f"    Reused the cached features of {num_cached} of {len(patient_ids)} patients with unchanged inputs")
+    for reason, pids in skipped.items():
+        if pids:
+            print(f"    Skipped {len(pids)} patients for {reason}: {', '.join(pids)}")
+    return patient_features
+
+
+@traced('evaluate_definition')
+def evaluate_definition(cancer_def, pirads_thre, iou_thre, mri_les_all_patients, tpm_les_patient_rows, localised_level, num_zones):
+    """
+    Calculates the metrics and bootstrap CIs of one cancer definition at one threshold pair.
 
+    Args:
+        mri_les_all_patients (list): One MRI zone row per patient.
+        tpm_les_patient_rows (list): One (samples, zones) TPM array per patient with TPM data.
+
+    Returns:
+        dict: Formatted log dict of the output table, None if the MRI and TPM rows do not match.
+    """
+    rows_per_patient = sample_times if localised_level in [2, 4, 8] and sampling_mode != 'exact' else 1
+
+    # Check for shape consistency before calculation
+    if len(tpm_les_patient_rows) != len(mri_les_all_patients):
+        print(f"    Skipping {cancer_def} due to shape mismatch: TPM ({sum(len(rows) for rows in tpm_les_patient_rows)}, {num_zones}) vs MRI ({len(mri_les_all_patients) * rows_per_patient}, {num_zones})")
+        return None
+
+    # unique (MRI, TPM) rows and the compact row of every sample
+    mri_les_all_patients_np, tpm_les_all_patients_np, row_index = compact_rows(mri_les_all_patients, tpm_les_patient_rows)
+    exact_counts = sampling_mode == 'exact' and localised_level in [2, 4, 8]
+    if exact_counts:
+        # expected counts per patient, on the same scale as sample_times draws
+        contributions = cm_contributions(tpm_les_all_patients_np, mri_les_all_patients_np)[row_index] * sample_times
+        TP, TN, FP, FN = contributions.sum(axis=0)
+    else:
+        TP, TN, FP, FN = calculate_cm(tpm_les_all_patients_np, mri_les_all_patients_np, np.bincount(row_index))
+    sensitivity, specificity, PPV, NPV = calculate_performance_metrics(TP, TN, FP, FN)
+
+    log_dict = {
+        "definition": cancer_def,
+        "pirads_thre": pirads_thre,
+        "iou_thre": iou_thre,
+        "TP": TP, "FP": FP, "FN": FN, "TN": TN,
+        "sensitivity": sensitivity, "specificity": specificity,
+        "PPV": PPV, "NPV": NPV,
+    }
+
+    # Print raw counts and averages per zone
+    print(f"    {cancer_def} - Raw Counts (TP/TN/FP/FN): {TP}, {TN}, {FP}, {FN}")
+    print(f"    {cancer_def} - Avg per Zone (TP/TN/FP/FN): {TP/num_zones:.2f}, {TN/num_zones:.2f}, {FP/num_zones:.2f}, {FN/num_zones:.2f}")
+    print(f"    {cancer_def} - Metrics: Sensitivity: {sensitivity:.2f}, Specificity: {specificity:.2f}, PPV: {PPV:.2f}, NPV: {NPV:.2f}")
+
+    # Bootstrap confidence intervals
+    if bootstrap_unit == 'patient':
+        sample_counts = contributions if exact_counts else cm_row_counts(tpm_les_all_patients_np, mri_les_all_patients_np)[row_index]
+        unit_counts = patient_counts(sample_counts, [len(rows) for rows in tpm_les_patient_rows])
+        sens_ci, spec_ci, PPV_ci, NPV_ci = bootstrap_count_ci(unit_counts)
+    elif exact_counts:
+        sens_ci, spec_ci, PPV_ci, NPV_ci = bootstrap_ci_from_contributions(contributions, sample_times)
+    else:
+        sens_ci, spec_ci, PPV_ci, NPV_ci = bootstrap_confidence_intervals(mri_les_all_patients_np, tpm_les_all_patients_np, row_index=row_index)
+    log_dict['sensitivity_ci'] = sens_ci
+    log_dict['specificity_ci'] = spec_ci
+    log_dict['PPV_ci'] = PPV_ci
+    log_dict['NPV_ci'] = NPV_ci
+
+    return format_log_dict(log_dict)
+
+
+def collect_patient_rows(patient_features, pirads_thre, iou_thre, localised_level, num_zones, tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index):
+    """
+    Builds the MRI zone rows of every reader and the TPM zone rows of every patient at one threshold pair.
+
+    In 'legacy' sampling mode the split Barzell zones are drawn here, continuing the random module stream.
+    The TPM rows are drawn once and shared by every reader.
+
+    Returns:
+        tuple: Per reader one MRI zone row per patient, and per definition one (samples, zones) TPM array per patient with TPM data.
+    """
+    # per reader one MRI row per patient, and per definition one (samples, zones) TPM array per patient
+    tpm_les_dict_all_patients = {k: [] for k in total_cancer_defs}
+    mri_les_dict_all_patients = {reader: [] for reader in readers}
+
+    with span('legacy_sampling' if sampling_mode == 'legacy' else 'collect_rows', pirads_thre=pirads_thre, iou_thre=iou_thre):
+        for pid, features in patient_features.items():
+            # Append MRI lesion status once, sampled TPM rows are weighted against it below
+            for reader, reader_features in features["readers"].items():
+                mri_les_dict_all_patients[reader].append(get_mri_zones(reader_features, pirads_thre, iou_thre))
+
+            # Process TPM(template mapped biopsy) Data
+            tpm = features['tpm']
+            if tpm is None:
+                continue
+            half_ratio_dict = features['half_ratio_dict']
+            quarter_ratio_dict = features['quarter_ratio_dict']
+            if sampling_mode != 'legacy':
                 for cancer_def in total_cancer_defs:
-                    tpm_les_all_patients_np = np.array(tpm_les_dict_all_patients[cancer_def])
-                    
-                    # Check for shape consistency before calculation
-                    if tpm_les_all_patients_np.shape != mri_les_all_patients_np.shape:
-                        print(f"    Skipping {cancer_def} due to shape mismatch: TPM {tpm_les_all_patients_np.shape} vs MRI {mri_les_all_patients_np.shape}")
-                        continue
-
-                    TP, TN, FP, FN = calculate_cm(tpm_les_all_patients_np, mri_les_all_patients_np)
-                    sensitivity, specificity, PPV, NPV = calculate_performance_metrics(TP, TN, FP, FN)
-
-                    log_dict = {
-                        "definition": cancer_def,
-                        "pirads_thre": pirads_thre,
-                        "iou_thre": iou_thre,
-                        "TP": TP, "FP": FP, "FN": FN, "TN": TN,
-                        "sensitivity": sensitivity, "specificity": specificity,
-                        "PPV": PPV, "NPV": NPV,
-                    }
-                    
-                    # Print raw counts and averages per zone
-                    print(f"    {cancer_def} - Raw Counts (TP/TN/FP/FN): {TP}, {TN}, {FP}, {FN}")
-                    print(f"    {cancer_def} - Avg per Zone (TP/TN/FP/FN): {TP/num_zones:.2f}, {TN/num_zones:.2f}, {FP/num_zones:.2f}, {FN/num_zones:.2f}")
-                    print(f"    {cancer_def} - Metrics: Sensitivity: {sensitivity:.2f}, Specificity: {specificity:.2f}, PPV: {PPV:.2f}, NPV: {NPV:.2f}")
-
-                    # Bootstrap confidence intervals
-                    sens_ci, spec_ci, PPV_ci, NPV_ci = bootstrap_confidence_intervals(mri_les_all_patients_np, tpm_les_all_patients_np)
-                    log_dict['sensitivity_ci'] = sens_ci
-                    log_dict['specificity_ci'] = spec_ci
-                    log_dict['PPV_ci'] = PPV_ci
-                    log_dict['NPV_ci'] = NPV_ci
-                
-                    log_dict_array_for_current_file.append(format_log_dict(log_dict))
-        
+                    tpm_les_dict_all_patients[cancer_def].append(features['tpm_zones'][cancer_def])
+                continue
+
+            # Apply cancer definitions to TPM data
+            for d, cancer_def in enumerate(total_cancer_defs):
+                t_zone_wc_20_level = tpm_zone_wc[pid]
+                t_cancer_info_20_level = tpm_cancer[patient_index[pid], :, d]
+                curr_zone_wc_20_level = [zone for zone in t_zone_wc_20_level if t_cancer_info_20_level[zone - 1] == 1]
+            
+                if localised_level == 20: # Direct mapping for 20-zone
+                    tpm_les_level_specific = np.zeros(num_zones)
+                    for zone_id_20 in curr_zone_wc_20_level:
+                        tpm_les_level_specific[zone_id_20 - 1] = 1
+                    tpm_les_dict_all_patients[cancer_def].append(tpm_les_level_specific[None])
+                else: 
+                    tpm_les_samples = []
+                    for _ in range(sample_times):
+                        tpm_les_level_specific = np.zeros(num_zones)
+                        for zone_id_20 in curr_zone_wc_20_level:
+                            if t_cancer_info_20_level[zone_id_20 - 1] == 1:
+                                new_zone_id_mapped = None
+                                if zone_id_20 in tpm_zone_map_config["half_map"]:
+                                    new_zone_id_mapped = random.choice(tpm_zone_map_config["half_map"][zone_id_20])
+                                elif localised_level == 8 and zone_id_20 in tpm_zone_map_config["quarter_map"]: # for 8-zone quarter mapping only
+                                    rand_num = random.random()
+                                    q_zones = tpm_zone_map_config["quarter_map"][zone_id_20]
+                                    ordered_ratios = np.array([quarter_ratio_dict[zone_id_20][qz] for qz in q_zones])
+                                    cumulative_ratios = np.cumsum(ordered_ratios)
+                                    selected_zone_index = np.searchsorted(cumulative_ratios, rand_num, side='right')
+                                    if selected_zone_index == len(q_zones):
+                                        selected_zone_index -= 1
+                                    new_zone_id_mapped = q_zones[selected_zone_index]
+                                    # if new_zone_id_mapped is None and q_zones: # Fallback for edge cases with float precision
+                                    #     new_zone_id_mapped = q_zones[-1]
+                                else: # Direct mapping from 20-zone to 2/4/8 zone
+                                    new_zone_id_mapped = tpm_zone_map_config["reverse_map"].get(zone_id_20)
+                                
+                                if new_zone_id_mapped is not None:
+                                    tpm_les_level_specific[new_zone_id_mapped - 1] = 1
+                        tpm_les_samples.append(tpm_les_level_specific)
+                    tpm_les_dict_all_patients[cancer_def].append(np.array(tpm_les_samples))
+
+    return mri_les_dict_all_patients, tpm_les_dict_all_patients
+
+
+def output_rows():
+    """(row_order, pirads_thre, iou_thre, reader, cancer_def) of every output row of one level and zone configuration, in table order."""
+    rows = []
+    for pirads_thre in pirads_thresholds:
+        for iou_thre in iou_thresholds:
+            for reader in readers:
+                for cancer_def in total_cancer_defs:
+                    rows.append((len(rows), pirads_thre, iou_thre, reader, cancer_def))
+    return rows
+
+
+def reader_log_dict(reader, log_dict):
+    """Starts an output row with its reader when several readers are evaluated, None for a skipped row."""
+    if log_dict is None or len(readers) == 1:
+        return log_dict
+    return dict({"reader": reader}, **log_dict)
+
+
+def patient_level_status(patient_features, tpm_cancer, tpm_zone_wc, patient_index):
+    """
+    MRI- and TPM-positive status of every patient with TPM data, reduced from the per-zone arrays of its features.
+
+    A patient is MRI-positive at a threshold pair when get_mri_zones marks any of its zones, that is when a lesion
+    scored at or above pirads_thre overlaps a zone with IoU above iou_thre, and TPM-positive for a definition
+    when any of its biopsied Barzell zones meets it (1, not the -99 of zones no rule matched).
+
+    Returns:
+        tuple: MRI status of shape (patients, readers, PI-RADS thresholds, IoU thresholds) and TPM status
+            of shape (patients, definitions).
+    """
+    with_tpm = [(pid, features) for pid, features in patient_features.items() if features["tpm"] is not None]
+    pirads_grid = np.array(pirads_thresholds, dtype=float)[:, None]
+    iou_grid = np.array(iou_thresholds, dtype=float)
+    mri_status = np.zeros((len(with_tpm), len(readers), len(pirads_thresholds), len(iou_thresholds)), dtype=bool)
+    tpm_status = np.zeros((len(with_tpm), len(total_cancer_defs)), dtype=bool)
+    for p, (pid, features) in enumerate(with_tpm):
+        for r, reader in enumerate(readers):
+            iou = features["readers"][reader]["iou"]
+            # lesion labels without a report entry are kept, see get_mri_zones
+            lesion_pirads = np.full(iou.shape[0], np.inf)
+            num_reported = min(len(features["readers"][reader]["pirads"]), len(lesion_pirads))
+            lesion_pirads[:num_reported] = features["readers"][reader]["pirads"][:num_reported]
+            # highest zone IoU of the lesions kept at every PI-RADS threshold
+            best_iou = np.where(lesion_pirads >= pirads_grid, iou.max(axis=1, initial=-np.inf), -np.inf).max(axis=1, initial=-np.inf)
+            mri_status[p, r] = best_iou[:, None] > iou_grid
+        zones = np.array(tpm_zone_wc[pid], dtype=np.intp) - 1
+        # -99 (no rule matched) is not cancer, as in collect_patient_rows
+        tpm_status[p] = (tpm_cancer[patient_index[pid], zones] == 1).any(axis=0)
+    return mri_status, tpm_status
+
+
+def patient_level_rows(patient_features, tpm_cancer, tpm_zone_wc, patient_index):
+    """
+    Calculates the patient-level accuracy of every output row, with bootstrap CIs of all rows from the same
+    replicates of resampled patients.
+
+    Returns:
+        list: (pirads_thre, iou_thre, reader, cancer_def, row_order, log_dict) of every row of output_rows.
+    """
+    mri_status, tpm_status = patient_level_status(patient_features, tpm_cancer, tpm_zone_wc, patient_index)
+    rows = output_rows()
+    reader_index = {reader: r for r, reader in enumerate(readers)}
+    r, t, i, d = (np.array(index, dtype=np.intp) for index in zip(*[(reader_index[reader], pirads_thresholds.index(pirads_thre), iou_thresholds.index(iou_thre), total_cancer_defs.index(cancer_def))
+                                                                    for _, pirads_thre, iou_thre, reader, cancer_def in rows]))
+    mri, tpm = mri_status[:, r, t, i], tpm_status[:, d]
+    # (patients, rows, 4) counts in TP, TN, FP, FN order
+    unit_counts = np.stack([mri & tpm, ~mri & ~tpm, mri & ~tpm, ~mri & tpm], axis=-1).astype(np.intp)
+    counts = unit_counts.sum(axis=0)
+    sens_ci, spec_ci, PPV_ci, NPV_ci = bootstrap_count_ci_cells(unit_counts)
+    print(f"    Patient-level accuracy of {len(tpm_status)} patients with TPM data")
+
+    patient_rows = []
+    for c, (row_order, pirads_thre, iou_thre, reader, cancer_def) in enumerate(rows):
+        TP, TN, FP, FN = counts[c]
+        sensitivity, specificity, PPV, NPV = calculate_performance_metrics(TP, TN, FP, FN)
+        log_dict = {
+            "definition": cancer_def,
+            "pirads_thre": pirads_thre,
+            "iou_thre": iou_thre,
+            "TP": TP, "FP": FP, "FN": FN, "TN": TN,
+            "sensitivity": sensitivity, "specificity": specificity,
+            "PPV": PPV, "NPV": NPV,
+            "sensitivity_ci": sens_ci[c], "specificity_ci": spec_ci[c], "PPV_ci": PPV_ci[c], "NPV_ci": NPV_ci[c],
+        }
+        patient_rows.append((pirads_thre, iou_thre, reader, cancer_def, row_order, reader_log_dict(reader, format_log_dict(log_dict))))
+    return patient_rows
+
+
+def run_analysis_for_localised_level(localised_level: int):
+    """
+    Runs the analysis for a specified zone level (2, 4, 8, or 20).
+
+    Every row is committed to the results store once computed, and a rerun only computes the rows
+    missing for the same inputs and code version. The Excel tables are exported from the store.
+
+    Args:
+        localised_level (int): The zone level to perform analysis for (2, 4, 8, or 20).
+    """
+    print(f"\n--- Running Analysis for {localised_level}-Zone Level ---")
+    random.seed(42) # Ensure reproducibility
+
+    patient_ids = load_patient_ids()
+    mri_dicts = load_mri_reports(patient_ids)
+    rules = load_rules()
+    # Evaluate every cancer definition on every TPM zone of every patient once
+    tpm_cancer, tpm_zone_wc = get_tpm_cancer_tensor(patient_ids, total_cancer_defs, rules)
+    patient_index = {pid: p for p, pid in enumerate(patient_ids)}
+
+    num_zones, zone_level_filename_part, tpm_zone_map_config = get_level_config(localised_level)
+
+    store = open_results_store()
+    rows = output_rows()
+    num_cells = len(rows)
+    keys = {zone_config: results_key(localised_level, zone_config, patient_ids) for zone_config in current_zone_configs}
+    done = {zone_config: stored_cells(store, key) for zone_config, key in keys.items()}
+    # legacy draws continue one random stream over the configurations, so stored configurations
+    # are replayed up to the last one with missing rows
+    incomplete = [zone_config for zone_config in current_zone_configs if len(done[zone_config]) < num_cells]
+    replay_until = current_zone_configs.index(incomplete[-1]) if incomplete and sampling_mode == 'legacy' else -1
+    # the patient-level rows draw nothing from the random module and are computed on their own
+    patient_incomplete = [zone_config for zone_config in current_zone_configs
+                          if patient_level_analysis and len(stored_cells(store, patient_level_key(keys[zone_config]))) < num_cells]
+
+    for c, zone_config in enumerate(current_zone_configs):
+        if zone_config in incomplete or c < replay_until or zone_config in patient_incomplete:
+            if done[zone_config]:
+                print(f"Resuming: {len(done[zone_config])} of {num_cells} rows of Zone Config='{zone_config}' already in the results store")
+
+            # Load every patient once, the threshold grid below only reads the extracted features
+            patient_features = extract_all_features(localised_level, zone_config, patient_ids, mri_dicts, tpm_cancer, tpm_zone_wc)
+            if zone_config in patient_incomplete:
+                for row in patient_level_rows(patient_features, tpm_cancer, tpm_zone_wc, patient_index):
+                    store_row(store, patient_level_key(keys[zone_config]), localised_level, zone_config, *row)
+
+            if zone_config in incomplete or c < replay_until:
+                for pirads_thre in pirads_thresholds:
+                    for iou_thre in iou_thresholds:
+                        missing = [(row_order, reader, cancer_def) for row_order, p, i, reader, cancer_def in rows
+                                   if (p, i) == (pirads_thre, iou_thre) and (float(p), float(i), reader, cancer_def) not in done[zone_config]]
+                        if not missing and sampling_mode != 'legacy':
+                            continue
+                        print(f"Processing: Zone Config='{zone_config}', Pirads={pirads_thre}, IoU={iou_thre:.1e}")
+
+                        mri_les_dict_all_patients, tpm_les_dict_all_patients = collect_patient_rows(patient_features, pirads_thre, iou_thre, localised_level, num_zones,
+                                                                                                    tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index)
+                        for row_order, reader, cancer_def in missing:
+                            if len(readers) > 1:
+                                print(f"    Reader '{reader}'")
+                            log_dict = evaluate_definition(cancer_def, pirads_thre, iou_thre, mri_les_dict_all_patients[reader], tpm_les_dict_all_patients[cancer_def], localised_level, num_zones)
+                            store_row(store, keys[zone_config], localised_level, zone_config, pirads_thre, iou_thre, reader, cancer_def, row_order, reader_log_dict(reader, log_dict))
+
         # --- Save Results to Excel ---
-        df = pd.DataFrame(log_dict_array_for_current_file)
-        
-        # Construct the filename similar to original scripts
-        filename = f"{zone_level_filename_part}_0_{zone_config}_multiiou.xlsx"
-        df.to_excel(filename, index=False)
-        print(f"Saved results to {filename}")
+        if export_excel:
+            # Construct the filename similar to original scripts
+            export_results_excel(store, keys[zone_config], f"{zone_level_filename_part}_0_{zone_config}_multiiou.xlsx")
+            if patient_level_analysis:
+                export_results_excel(store, patient_level_key(keys[zone_config]), f"{zone_level_filename_part}_0_{zone_config}_patient.xlsx")
+    store.close()
+
+
+def pack_features(patient_features, feature_dir, num_zones):
+    """
+    Saves the features the threshold grid reads as flat arrays, so sweep workers memory-map them instead of unpickling.
+
+    Lesions of every reader are stacked over all patients with the patient of every lesion, and the TPM
+    rows of every definition are stacked with the number of rows of every patient with TPM data.
+    """
+    features = list(patient_features.values())
+    arrays = {"num_patients": np.array([len(features)])}
+    for r, reader in enumerate(readers):
+        iou = [f["readers"][reader]["iou"] for f in features]
+        pirads = []
+        for f in features:
+            # lesion labels without a report entry are always kept, see get_mri_zones
+            lesion_pirads = np.full(f["readers"][reader]["iou"].shape[0], np.inf)
+            num_reported = min(len(f["readers"][reader]["pirads"]), len(lesion_pirads))
+            lesion_pirads[:num_reported] = f["readers"][reader]["pirads"][:num_reported]
+            pirads.append(lesion_pirads)
+        arrays[f"iou_{r}"] = np.concatenate(iou) if iou else np.zeros((0, num_zones))
+        arrays[f"pirads_{r}"] = np.concatenate(pirads) if pirads else np.zeros(0)
+        arrays[f"lesion_patient_{r}"] = np.repeat(np.arange(len(features)), [len(i) for i in iou])
+
+    with_tpm = [f for f in features if f["tpm"] is not None]
+    for d, cancer_def in enumerate(total_cancer_defs):
+        groups = [f["tpm_zones"][cancer_def] for f in with_tpm]
+        arrays[f"tpm_{d}"] = np.concatenate(groups) if groups else np.zeros((0, num_zones))
+        arrays[f"tpm_{d}_sizes"] = np.array([len(g) for g in groups], dtype=np.intp)
+    save_array_dir(feature_dir, arrays)
+
+
+def unpack_rows(packed, r, d, pirads_thre, iou_thre):
+    """MRI rows of reader r for every patient and TPM row groups of definition d from packed features, as the threshold loop builds them."""
+    num_zones = packed[f"iou_{r}"].shape[1]
+    hit = (packed[f"iou_{r}"] > iou_thre) & (packed[f"pirads_{r}"] >= pirads_thre)[:, None]
+    lesion_hits = np.zeros((int(packed["num_patients"][0]), num_zones), dtype=np.intp)
+    np.add.at(lesion_hits, packed[f"lesion_patient_{r}"], hit)
+    mri_les_all_patients = list((lesion_hits > 0).astype(float))
+    sizes = packed[f"tpm_{d}_sizes"]
+    tpm_les_patient_rows = np.split(np.asarray(packed[f"tpm_{d}"]), np.cumsum(sizes)[:-1]) if len(sizes) else []
+    return mri_les_all_patients, tpm_les_patient_rows
+
+
+def prepare_sweep_features(localised_level, zone_config, patient_level=False):
+    """
+    Sweep task extracting and packing the features of one level and zone configuration.
+
+    Args:
+        patient_level (bool): Also calculate the patient-level rows from the extracted features.
+
+    Returns:
+        tuple: Feature directory, the captured console output and the patient_level_rows (None without patient_level).
+    """
+    output = io.StringIO()
+    patient_rows = None
+    with contextlib.redirect_stdout(output):
+        patient_ids = load_patient_ids()
+        mri_dicts = load_mri_reports(patient_ids)
+        tpm_cancer, tpm_zone_wc = get_tpm_cancer_tensor(patient_ids, total_cancer_defs, load_rules())
+        patient_features = extract_all_features(localised_level, zone_config, patient_ids, mri_dicts, tpm_cancer, tpm_zone_wc)
+        if patient_level:
+            patient_rows = patient_level_rows(patient_features, tpm_cancer, tpm_zone_wc, {pid: p for p, pid in enumerate(patient_ids)})
+    feature_dir = os.path.join(sweep_feature_dir, f"{localised_level}level_{zone_config}")
+    pack_features(patient_features, feature_dir, get_level_config(localised_level)[0])
+    flush_events()
+    return feature_dir, output.getvalue(), patient_rows
+
+
+_packed_features = {} # memory-mapped features opened by this process, per feature directory
+
+def run_sweep_task(feature_dir, localised_level, r, d, pirads_thre, iou_thre):
+    """
+    Sweep task evaluating one reader and cancer definition at one threshold pair from packed features.
+
+    Returns:
+        tuple: Formatted log dict (None if skipped) and the captured console output.
+    """
+    if feature_dir not in _packed_features:
+        _packed_features[feature_dir] = load_array_dir(feature_dir)
+    packed = _packed_features[feature_dir]
+    mri_les_all_patients, tpm_les_patient_rows = unpack_rows(packed, r, d, pirads_thre, iou_thre)
+    reader = list(readers)[r]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        if len(readers) > 1:
+            print(f"    Reader '{reader}'")
+        log_dict = evaluate_definition(total_cancer_defs[d], pirads_thre, iou_thre, mri_les_all_patients, tpm_les_patient_rows,
+                                       localised_level, packed[f"iou_{r}"].shape[1])
+    flush_events()
+    return reader_log_dict(reader, log_dict), output.getvalue()
+
+
+def run_sweep_shard(function, task_args):
+    """Queue task calling a sweep task function of this module for a shard of argument tuples."""
+    results = [globals()[function](*args) for args in task_args]
+    # features are prepared again by the next run, a long-lived queue worker must not keep them mapped
+    _packed_features.clear()
+    return results
+
+
+def queued_map(fn, *iterables, shard_size=queue_shard_size):
+    """map of a sweep task function through the work queue, shard_size calls per queue task, results in order."""
+    task_args = list(zip(*iterables))
+    shards = [(fn.__name__, task_args[i:i + shard_size]) for i in range(0, len(task_args), shard_size)]
+    return (result for shard_results in run_queued('localised_analysis', 'run_sweep_shard', shards) for result in shard_results)
+
+
+def run_sweep(localised_levels, zone_configs=current_zone_configs, num_workers=num_workers):
+    """
+    Runs every (level, zone config, PI-RADS, IoU, reader, definition) cell as an independent task.
+
+    Features are extracted once per level and zone configuration and memory-mapped by the
+    workers. Output files, rows and console output keep the order of the serial loops.
+    'legacy' sampling runs serially through run_analysis_for_localised_level, because its
+    draws continue one random module stream across the whole grid. Rows are committed to the
+    results store as they arrive and rows already stored for the same inputs are not recomputed.
+
+    Args:
+        num_workers (int): Number of worker processes. 1 runs every task in this process.
+            Ignored with queue_dir set, the tasks are then run in shards by this process and
+            the queue workers, and only this process writes to the results store.
+    """
+    if sampling_mode == 'legacy':
+        for level in localised_levels:
+            run_analysis_for_localised_level(level)
+        return
+
+    file_keys = [(level, zone_config) for level in localised_levels for zone_config in zone_configs]
+    rows = output_rows()
+    reader_index = {reader: r for r, reader in enumerate(readers)}
+    patient_ids = load_patient_ids()
+    store = open_results_store()
+    keys = [results_key(level, zone_config, patient_ids) for level, zone_config in file_keys]
+    done = [stored_cells(store, key) for key in keys]
+    missing = [[row for row in rows if (float(row[1]), float(row[2]), row[3], row[4]) not in file_done] for file_done in done]
+    patient_missing = [patient_level_analysis and len(stored_cells(store, patient_level_key(key))) < len(rows) for key in keys]
+    to_prepare = [f for f in range(len(file_keys)) if missing[f] or patient_missing[f]]
+
+    with ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 and queue_dir is None else contextlib.nullcontext() as executor:
+        map_fn = queued_map if queue_dir is not None else map if executor is None else executor.map
+        # every level and zone configuration is prepared by its own queue task
+        prepare_map = functools.partial(queued_map, shard_size=1) if queue_dir is not None else map_fn
+        prepared = dict(zip(to_prepare, prepare_map(prepare_sweep_features, *zip(*[file_keys[f] + (patient_missing[f],) for f in to_prepare])))) if to_prepare else {}
+        for f, (_, _, patient_rows) in prepared.items():
+            for row in patient_rows or []:
+                store_row(store, patient_level_key(keys[f]), *file_keys[f], *row)
+        tasks = [(f,) + row for f in to_prepare for row in missing[f]]
+        task_args = [(prepared[f][0], file_keys[f][0], reader_index[reader], total_cancer_defs.index(cancer_def), pirads_thre, iou_thre)
+                     for f, _, pirads_thre, iou_thre, reader, cancer_def in tasks]
+        outputs = {}
+        # every row is committed to the results store as soon as it arrives
+        results = map_fn(run_sweep_task, *zip(*task_args)) if task_args else []
+        for (f, row_order, pirads_thre, iou_thre, reader, cancer_def), (log_dict, task_output) in tqdm.tqdm(zip(tasks, results), total=len(tasks), desc="    Tasks"):
+            level, zone_config = file_keys[f]
+            store_row(store, keys[f], level, zone_config, pirads_thre, iou_thre, reader, cancer_def, row_order, log_dict)
+            outputs[f, row_order] = task_output
+    _packed_features.clear()
+
+    for f, (level, zone_config) in enumerate(file_keys):
+        print(f"\n--- Running Analysis for {level}-Zone Level ---")
+        if done[f]:
+            print(f"Resuming: {len(done[f])} of {len(rows)} rows of Zone Config='{zone_config}' already in the results store")
+        if f in prepared:
+            print(prepared[f][1], end="")
+        for pirads_thre in pirads_thresholds:
+            for iou_thre in iou_thresholds:
+                cell_outputs = [outputs[f, row[0]] for row in rows if (row[1], row[2]) == (pirads_thre, iou_thre) and (f, row[0]) in outputs]
+                if cell_outputs:
+                    print(f"Processing: Zone Config='{zone_config}', Pirads={pirads_thre}, IoU={iou_thre:.1e}")
+                    print(''.join(cell_outputs), end="")
+
+        if export_excel:
+            export_results_excel(store, keys[f], f"{get_level_config(level)[1]}_0_{zone_config}_multiiou.xlsx")
+            if patient_level_analysis:
+                export_results_excel(store, patient_level_key(keys[f]), f"{get_level_config(level)[1]}_0_{zone_config}_patient.xlsx")
+    store.close()
 
 
 if __name__ == "__main__":
     # Define which zone levels to run the analysis for
     localised_levels_to_run = [ 20, 8, 4, 2] 
     # localised_levels_to_run = [2, ]
-    for level in localised_levels_to_run:
-        run_analysis_for_localised_level(level)
\ No newline at end of file
+    run_sweep(localised_levels_to_run)
+    write_trace()
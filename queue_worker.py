@@ -0,0 +1,18 @@
+import argparse
+from config import queue_dir
+from utils.queue_utils import run_worker
+from utils.trace_utils import flush_events
+
+if __name__ == "__main__":
+    # Start any number of workers on nodes sharing queue_dir, each runs the zone generation and
+    # analysis sweep tasks of gen_localised_zones.py and localised_analysis.py runs with the same queue_dir
+    parser = argparse.ArgumentParser(description="Claim and run tasks from the shared-filesystem work queue")
+    parser.add_argument('--queue-dir', default=queue_dir)
+    parser.add_argument('--idle-timeout', type=float, default=None, help="Exit after this many seconds without a task to run (default: wait forever)")
+    args = parser.parse_args()
+    if args.queue_dir is None:
+        parser.error("set queue_dir in config.py or pass --queue-dir")
+    try:
+        run_worker(args.queue_dir, args.idle_timeout)
+    finally:
+        flush_events()
@@ -0,0 +1,123 @@
+# roc_analysis.py
+import pandas as pd
+import numpy as np
+from config import *
+from localised_analysis import get_level_config, extract_all_features, get_patient_tpm_zones, reader_log_dict
+from utils.stat_utils import *
+from utils.trace_utils import span, write_trace
+
+def iou_scores(reader_features, pirads_thre):
+    """
+    Highest IoU of the lesions scored at or above pirads_thre with every zone, so that the zones get_mri_zones
+    marks at an IoU threshold are those scored above it. -inf for zones without such lesions.
+    """
+    iou = reader_features["iou"]
+    pirads = reader_features["pirads"][:iou.shape[0]]
+    # lesion labels without a report entry are kept, as in get_mri_zones
+    keep = np.ones(iou.shape[0], dtype=bool)
+    keep[:len(pirads)] = pirads >= pirads_thre
+    return iou[keep].max(axis=0, initial=-np.inf)
+
+
+def pirads_scores(reader_features, iou_thre):
+    """
+    Highest PI-RADS score of the lesions with IoU above iou_thre with every zone, so that the zones get_mri_zones
+    marks at a PI-RADS threshold are those scored at or above it. Lesion labels without a report entry score inf.
+    """
+    iou = reader_features["iou"]
+    pirads = np.full(iou.shape[0], np.inf)
+    pirads[:len(reader_features["pirads"])] = np.nan_to_num(reader_features["pirads"][:iou.shape[0]], nan=-np.inf)
+    return np.where(iou > iou_thre, pirads[:, None], -np.inf).max(axis=0, initial=-np.inf)
+
+
+def zone_truth_weights(tpm_rows, scale):
+    """Cancer-positive and -negative weights of every zone over the TPM rows of one patient, scale times the row counts."""
+    pos = np.asarray(tpm_rows, dtype=float).sum(axis=0)
+    return pos * scale, (len(tpm_rows) - pos) * scale
+
+
+def roc_curve_rows(scores, pos_weights, neg_weights, row_patient, num_patients, strict, fpr_grid):
+    """
+    ROC curve of one score at every distinct finite zone score, its AUC with bootstrap CI and its bootstrap
+    sensitivity bands, resampling whole patients.
+
+    Returns:
+        tuple: Per-threshold log dicts, the AUC log dict and the band log dicts.
+    """
+    thresholds = np.unique(scores[np.isfinite(scores)])
+    counts = roc_counts(scores, pos_weights, neg_weights, thresholds, strict)
+    auc_ci, band_lo, band_hi = bootstrap_roc(scores, pos_weights, neg_weights, thresholds, row_patient, num_patients, fpr_grid, strict)
+
+    curve = []
+    for threshold, (TP, TN, FP, FN) in zip(thresholds, counts):
+        sensitivity, specificity, PPV, NPV = calculate_performance_metrics(TP, TN, FP, FN)
+        curve.append({"threshold": threshold, "TP": TP, "FP": FP, "FN": FN, "TN": TN,
+                      "sensitivity": sensitivity, "specificity": specificity, "PPV": PPV, "NPV": NPV})
+    auc = {"AUC": roc_auc(counts), "AUC_ci": tuple(float(x) for x in auc_ci), "num_thresholds": len(thresholds)}
+    bands = [{"fpr": fpr, "sensitivity_lo": lo, "sensitivity_hi": hi} for fpr, lo, hi in zip(fpr_grid, band_lo, band_hi)]
+    return curve, auc, bands
+
+
+def run_roc_analysis(localised_levels, zone_configs=current_zone_configs):
+    """
+    Computes the full ROC curves of the zone-level analysis over continuous thresholds.
+
+    Every patient is loaded once per level and zone configuration. For every reader and cancer definition
+    the IoU threshold is swept at each of pirads_thresholds, and the PI-RADS threshold at each of
+    iou_thresholds, each curve in one sorted cumulative pass over all zone rows instead of one patient
+    loop per threshold. The TPM zone rows of split Barzell zones come from the numpy sampling of
+    get_tpm_zones, also in 'legacy' mode, and are shared by every threshold. Only patients with TPM data
+    are counted.
+    Writes one Excel file per level and zone configuration with the curve, AUC and band sheets.
+    """
+    patient_ids = load_patient_ids()
+    mri_dicts = load_mri_reports(patient_ids)
+    tpm_cancer, tpm_zone_wc = get_tpm_cancer_tensor(patient_ids, total_cancer_defs, load_rules())
+    patient_index = {pid: p for p, pid in enumerate(patient_ids)}
+    fpr_grid = np.linspace(0, 1, roc_fpr_points)
+
+    for localised_level in localised_levels:
+        print(f"\n--- ROC curves for {localised_level}-Zone Level ---")
+        num_zones, zone_level_filename_part, tpm_zone_map_config = get_level_config(localised_level)
+        # expected counts on the same scale as sample_times draws, as evaluate_definition counts them
+        scale = sample_times if sampling_mode == 'exact' and localised_level in [2, 4, 8] else 1
+
+        for zone_config in zone_configs:
+            patient_features = extract_all_features(localised_level, zone_config, patient_ids, mri_dicts, tpm_cancer, tpm_zone_wc)
+            patient_features = {pid: features for pid, features in patient_features.items() if features["tpm"] is not None}
+            for pid, features in patient_features.items():
+                if "tpm_zones" not in features:
+                    features["tpm_zones"] = get_patient_tpm_zones(pid, features, localised_level, num_zones, tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index)
+            row_patient = np.repeat(np.arange(len(patient_features)), num_zones)
+
+            curve_rows, auc_rows, band_rows = [], [], []
+            curves = [("iou", "pirads_thre", pirads_thre, iou_scores, True) for pirads_thre in pirads_thresholds]
+            curves += [("pirads", "iou_thre", iou_thre, pirads_scores, False) for iou_thre in iou_thresholds]
+            for reader in readers:
+                for cancer_def in total_cancer_defs:
+                    weights = [zone_truth_weights(features["tpm_zones"][cancer_def], scale) for features in patient_features.values()]
+                    pos_weights = np.concatenate([pos for pos, _ in weights]) if weights else np.zeros(0)
+                    neg_weights = np.concatenate([neg for _, neg in weights]) if weights else np.zeros(0)
+                    for curve, fixed_name, fixed_thre, score_fn, strict in curves:
+                        print(f"Processing: Zone Config='{zone_config}', Reader='{reader}', {cancer_def}, {curve} curve at {fixed_name}={fixed_thre}")
+                        with span('roc_curve', curve=curve, cancer_def=cancer_def):
+                            scores = np.concatenate([score_fn(features["readers"][reader], fixed_thre) for features in patient_features.values()]) if weights else np.zeros(0)
+                            points, auc, bands = roc_curve_rows(scores, pos_weights, neg_weights, row_patient, len(patient_features), strict, fpr_grid)
+                        head = {"definition": cancer_def, "curve": curve, fixed_name: fixed_thre}
+                        curve_rows += [reader_log_dict(reader, dict(head, **row)) for row in points]
+                        auc_rows.append(reader_log_dict(reader, dict(head, **auc)))
+                        band_rows += [reader_log_dict(reader, dict(head, **row)) for row in bands]
+                        print(f"    AUC: {auc['AUC']:.3f} ({auc['AUC_ci'][0]:.3f}, {auc['AUC_ci'][1]:.3f})")
+
+            filename = f"{zone_level_filename_part}_0_{zone_config}_roc.xlsx"
+            with span('excel_export'), pd.ExcelWriter(filename) as writer:
+                pd.DataFrame(auc_rows).to_excel(writer, sheet_name='auc', index=False)
+                pd.DataFrame(curve_rows).to_excel(writer, sheet_name='curves', index=False)
+                pd.DataFrame(band_rows).to_excel(writer, sheet_name='bands', index=False)
+            print(f"Saved ROC curves to {filename}")
+
+
+if __name__ == "__main__":
+    localised_levels_to_run = [20, 8, 4, 2]
+    run_roc_analysis(localised_levels_to_run)
+    write_trace()
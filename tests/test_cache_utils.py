@@ -0,0 +1,13 @@
+import os
+import pytest
+from utils.cache_utils import atomic_save
+
+
+def test_atomic_save_removes_temporary_file_on_failure(tmp_path):
+    file_path = os.path.join(tmp_path, 'entry.pkl')
+    def fail(f):
+        f.write(b'partial')
+        raise OSError('disk full')
+    with pytest.raises(OSError):
+        atomic_save(fail, file_path)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,19 @@
+import os,time
+import numpy as np
+import nibabel as nib
+from gen_localised_zones import zone_mask_image, save_zone_mask
+
+
+def test_save_zone_mask_is_byte_identical(tmp_path):
+    t2_img = nib.Nifti1Image(np.zeros((8, 8, 4), dtype=np.int16), np.eye(4))
+    zone_mask = np.random.default_rng(0).integers(0, 9, size=(8, 8, 4)).astype('uint8')
+    contents = []
+    for run in range(2):
+        file_path = os.path.join(tmp_path, f'run{run}', 'gland_zone_8level_set1.nii.gz')
+        os.makedirs(os.path.dirname(file_path))
+        save_zone_mask(zone_mask_image(zone_mask, t2_img), file_path, 'P-0')
+        with open(file_path, 'rb') as f:
+            contents.append(f.read())
+        time.sleep(1.1)
+    assert contents[0] == contents[1]
+    assert np.array_equal(np.asarray(nib.load(file_path).dataobj), zone_mask)
@@ -0,0 +1,30 @@
+import numpy as np
+import localised_analysis as la
+
+
+def test_zone_map_change_extracts_features_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(la, 'manifest_dir', str(tmp_path))
+    monkeypatch.setattr(la, 'load_patient_inputs', lambda pid, zone_config, localised_level: None)
+    extracted = []
+    monkeypatch.setattr(la, 'extract_patient_features', lambda pid, *args: extracted.append(pid) or {'tpm': None})
+    mri_dicts = {reader: {'P-0': [3]} for reader in la.readers}
+
+    for _ in range(2):
+        la.extract_all_features(8, 'set1', ['P-0'], mri_dicts, None, None)
+    assert extracted == ['P-0']
+
+    octant_zone = {**la.octant_zone, 1: [3, 9], 5: [10, 4, 12, 11]}
+    monkeypatch.setattr(la, 'octant_zone', octant_zone)
+    la.extract_all_features(8, 'set1', ['P-0'], mri_dicts, None, None)
+    assert extracted == ['P-0', 'P-0']
+
+
+def test_patient_level_status_ignores_unmatched_zones():
+    features = {"tpm": object(), "readers": {reader: {"iou": np.zeros((1, 8)), "pirads": np.array([3.])} for reader in la.readers}}
+    patient_features = {'P-0': features, 'P-1': features}
+    tpm_cancer = np.full((2, 20, len(la.total_cancer_defs)), -99.)
+    tpm_cancer[1, 4, 0] = 1
+    tpm_zone_wc = {'P-0': [3, 5, 9], 'P-1': [3, 5, 9]}
+    _, tpm_status = la.patient_level_status(patient_features, tpm_cancer, tpm_zone_wc, {'P-0': 0, 'P-1': 1})
+    assert not tpm_status[0].any()
+    assert tpm_status[1].tolist() == [True] + [False] * (len(la.total_cancer_defs) - 1)
@@ -0,0 +1,259 @@
+import numpy as np
+import nibabel as nib
+import contextlib,hashlib,json,os,pickle,socket
+from utils.trace_utils import span
+
+zone_mask_extensions = ['.nii.gz', '.nii'] # in the order find_zone_mask prefers them
+
+def file_fingerprint(file_path):
+    """Identifies a source file by its absolute path, modification time and size."""
+    stat = os.stat(file_path)
+    return {'path': os.path.abspath(file_path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def source_hash(file_paths):
+    """Hash of the contents of source files, e.g. the code a cache entry was computed by."""
+    digest = hashlib.sha1()
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f:
+            digest.update(os.path.basename(file_path).encode() + f.read())
+    return digest.hexdigest()
+
+
+def input_fingerprint(file_paths, **values):
+    """
+    Manifest entry of the inputs of one patient: the fingerprint of every input file (None when
+    it does not exist) and any other input values, normalised to how they are stored as JSON.
+    """
+    files = {file_path: file_fingerprint(file_path) if os.path.exists(file_path) else None for file_path in file_paths}
+    return json.loads(json.dumps({'files': files, **values}, sort_keys=True, default=str))
+
+
+def load_patient_cache(cache_dir, pid, inputs):
+    """
+    Loads what was cached for a patient from the same inputs.
+
+    Returns:
+        tuple: (hit, data), hit False when nothing was cached or the inputs changed.
+    """
+    if cache_dir is None or not os.path.exists(os.path.join(cache_dir, f'{pid}.pkl')):
+        return False, None
+    cache_path = os.path.join(cache_dir, f'{pid}.pkl')
+    with open(cache_path, 'rb') as f:
+        cached = pickle.load(f)
+    if cached['inputs'] != inputs:
+        return False, None
+    return True, cached['data']
+
+
+def save_patient_cache(cache_dir, pid, inputs, data):
+    """Caches data computed for a patient, with the manifest entry of its inputs."""
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_save(lambda f: pickle.dump({'inputs': inputs, 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL), os.path.join(cache_dir, f'{pid}.pkl'))
+
+
+def cache_file_path(cache_dir, file_path, suffix):
+    """Cache entry path of a source file, named after the hash of its absolute path."""
+    key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+    return os.path.join(cache_dir, f'{key}{suffix}')
+
+
+def atomic_save(save_fn, file_path, mode='wb'):
+    """
+    Writes through a temporary file so concurrent readers never see a partial cache entry, and a writer killed
+    midway leaves no partial file. The temporary file is unique per host and process, for shared storage,
+    and removed when save_fn raises.
+    """
+    tmp_path = f'{file_path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            save_fn(f)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def label_dtype(max_label):
+    """Smallest unsigned integer dtype holding the labels."""
+    return np.uint8 if max_label < 2**8 else np.uint16 if max_label < 2**16 else np.uint32
+
+
+def crop_to_nonzero(arr):
+    """Crops a volume to the bounding box of its non-zero voxels and returns the crop offset."""
+    non_zero_indices = np.nonzero(arr)
+    if len(non_zero_indices[0]) == 0:
+        return arr[:0, :0, :0], (0, 0, 0)
+    lo = [int(np.min(idx)) for idx in non_zero_indices]
+    hi = [int(np.max(idx)) + 1 for idx in non_zero_indices]
+    return arr[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]], tuple(lo)
+
+
+def zone_mask_path(nii_dir, pid, zone_config, localised_level=None, extension='.nii.gz'):
+    """Path of the zone mask of one level, or of the combined file of every level of a zone configuration for localised_level None."""
+    file_name = f'gland_zone_{zone_config}' if localised_level is None else f'gland_zone_{localised_level}level_{zone_config}'
+    return os.path.join(nii_dir, pid, file_name + extension)
+
+
+def combined_levels(file_path):
+    """Levels of a combined zone mask file in volume order, from the 'levels=20,8,...' description of its header."""
+    descrip = nib.load(file_path).header['descrip'].item().decode()
+    if not descrip.startswith('levels='):
+        return []
+    return [int(level) for level in descrip[len('levels='):].split(',')]
+
+
+def find_zone_mask(nii_dir, pid, zone_config, localised_level):
+    """
+    Finds the zone mask of one level in whichever format gen_localised_zones wrote it: a per-level
+    .nii.gz or .nii file, or else a volume of the combined file of the zone configuration.
+
+    Returns:
+        tuple: (file_path, volume) with the volume index in a combined file (None for a per-level
+            file), None when no file holds the level.
+    """
+    for extension in zone_mask_extensions:
+        file_path = zone_mask_path(nii_dir, pid, zone_config, localised_level, extension)
+        if os.path.exists(file_path):
+            return file_path, None
+    for extension in zone_mask_extensions:
+        file_path = zone_mask_path(nii_dir, pid, zone_config, None, extension)
+        levels = combined_levels(file_path) if os.path.exists(file_path) else []
+        if localised_level in levels:
+            return file_path, levels.index(localised_level)
+    return None
+
+
+def read_label_array(file_path, volume=None):
+    """Decodes a NIfTI volume as float64 like get_fdata, only the given volume of a 4D file."""
+    img = nib.load(file_path)
+    if volume is None:
+        return img.get_fdata()
+    return np.asarray(img.dataobj[..., volume], dtype=np.float64)
+
+
+def load_label_volume(file_path, cache_dir, volume=None):
+    """
+    Loads an integer label volume through an uncompressed, memory-mapped cache.
+
+    On a cache miss the NIfTI file is decoded once, stored with the smallest unsigned dtype
+    and cropped to the bounding box of its labels (the gland bounding box for zone masks),
+    next to a json record of the source fingerprint, crop offset and full shape. The entry
+    is rebuilt whenever the path, mtime or size of the source file changes.
+
+    Args:
+        volume (int): Volume of a 4D file such as a combined zone mask file, None for a 3D file.
+
+    Returns:
+        tuple: (data, offset, shape) with the cropped read-only array, the (x, y, z) offset
+            of the crop and the shape of the full volume.
+    """
+    suffix = '' if volume is None else f'.{volume}'
+    data_path = cache_file_path(cache_dir, file_path, f'{suffix}.npy')
+    meta_path = cache_file_path(cache_dir, file_path, f'{suffix}.json')
+    fingerprint = file_fingerprint(file_path)
+
+    if os.path.exists(meta_path) and os.path.exists(data_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['source'] == fingerprint:
+            data = np.load(data_path, mmap_mode='r') if np.prod(meta['crop_shape']) > 0 else np.load(data_path)
+            return data, tuple(meta['offset']), tuple(meta['shape'])
+
+    with span('nifti_decode', path=file_path):
+        arr = read_label_array(file_path, volume)
+    labels = np.rint(arr)
+    assert np.array_equal(labels, arr) and labels.min(initial=0) >= 0, f"{file_path} is not a label volume"
+    data, offset = crop_to_nonzero(labels.astype(label_dtype(labels.max(initial=0))))
+    data = np.ascontiguousarray(data)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_save(lambda f: np.save(f, data), data_path)
+    meta = {'source': fingerprint, 'offset': offset, 'shape': arr.shape, 'crop_shape': data.shape}
+    atomic_save(lambda f: json.dump(meta, f), meta_path, 'w')
+    return data, offset, tuple(arr.shape)
+
+
+def sparse_labels(data, offset, shape):
+    """
+    Lists the labelled voxels of a cropped label volume as flat voxel indices grouped by label.
+
+    Returns:
+        tuple: (indices, label_counts, shape) with the C-order indices into the full volume of the
+            voxels of label 1, then label 2 and so on, the voxel count of every label (0 for the
+            background, whose voxels are not listed) and the shape of the full volume.
+    """
+    data = np.asarray(data)
+    local = np.flatnonzero(data)
+    labels = data.ravel()[local].astype(np.intp)
+    local = local[np.argsort(labels, kind='stable')]
+    coords = np.unravel_index(local, data.shape)
+    indices = np.ravel_multi_index(tuple(c + o for c, o in zip(coords, offset)), shape).astype(np.int64)
+    label_counts = np.bincount(labels, minlength=1)
+    label_counts[0] = 0
+    return indices, label_counts, tuple(shape)
+
+
+def load_sparse_labels(file_path, cache_dir):
+    """
+    Loads a label volume as sparse_labels through the volume cache, for masks labelling a tiny
+    fraction of the volume such as lesions. The entry is rebuilt whenever the source file changes.
+    """
+    data_path = cache_file_path(cache_dir, file_path, '.idx.npy')
+    meta_path = cache_file_path(cache_dir, file_path, '.idx.json')
+    fingerprint = file_fingerprint(file_path)
+
+    if os.path.exists(meta_path) and os.path.exists(data_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['source'] == fingerprint:
+            return np.load(data_path), np.array(meta['label_counts'], dtype=np.intp), tuple(meta['shape'])
+
+    indices, label_counts, shape = sparse_labels(*load_label_volume(file_path, cache_dir))
+    atomic_save(lambda f: np.save(f, indices), data_path)
+    meta = {'source': fingerprint, 'shape': shape, 'label_counts': label_counts.tolist()}
+    atomic_save(lambda f: json.dump(meta, f), meta_path, 'w')
+    return indices, label_counts, shape
+
+
+def save_array_dir(array_dir, arrays):
+    """Saves named arrays as .npy files of one directory, replacing any previous contents."""
+    os.makedirs(array_dir, exist_ok=True)
+    for file_name in os.listdir(array_dir):
+        if file_name.endswith('.npy'):
+            os.remove(os.path.join(array_dir, file_name))
+    for name, arr in arrays.items():
+        atomic_save(lambda f: np.save(f, np.ascontiguousarray(arr)), os.path.join(array_dir, f'{name}.npy'))
+
+
+def load_array_dir(array_dir):
+    """Memory-maps the arrays saved by save_array_dir, read-only."""
+    return {file_name[:-4]: np.load(os.path.join(array_dir, file_name), mmap_mode='r')
+            for file_name in sorted(os.listdir(array_dir)) if file_name.endswith('.npy')}
+
+
+def load_cached_pickle(cache_path, source_files, build_fn):
+    """
+    Loads build_fn() through a pickle cache that is rebuilt when any source file changes.
+
+    Args:
+        cache_path (str): Cache file, None to always call build_fn.
+        source_files (list): Files whose path, mtime and size key the cache entry.
+        build_fn (callable): Builds the cached object from the source files.
+    """
+    if cache_path is None:
+        return build_fn()
+    fingerprint = [file_fingerprint(file_path) for file_path in source_files]
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['sources'] == fingerprint:
+            return cached['data']
+
+    data = build_fn()
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    atomic_save(lambda f: pickle.dump({'sources': fingerprint, 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL), cache_path)
+    return data
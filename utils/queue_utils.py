@@ -0,0 +1,211 @@
+from config import queue_dir, queue_heartbeat_seconds, queue_stale_seconds
+import contextlib,functools,importlib,json,os,pickle,shutil,socket,threading,time,traceback
+from utils.cache_utils import atomic_save
+from utils.results_utils import code_version
+
+# A job is a directory of the queue directory holding job.json (code version and working directory),
+# tasks/<task>.pkl descriptors, claims/<task>.json claims and results/<task>.pkl partial results.
+# Claims are created with O_EXCL, so exactly one worker holds a task, and touched every
+# queue_heartbeat_seconds while it runs. Claims untouched for queue_stale_seconds are recovered: a
+# worker renames the claim to a name of its own, which only one worker can do per claim file, and
+# only deletes it when the renamed claim is still stale. A live worker paused for longer than
+# queue_stale_seconds can still lose its claim, results are written atomically so the task then
+# just runs twice.
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+@functools.lru_cache(maxsize=None)
+def loaded_code_version():
+    """Code version of the modules this process imported, workers skip jobs submitted by other code."""
+    return code_version()
+
+
+def submit_job(module, function, task_args, queue_dir=queue_dir):
+    """
+    Writes one task per argument tuple, each calling module.function(*args) on a queue worker.
+
+    Returns:
+        str: Job directory, see wait_for_job.
+    """
+    job_dir = os.path.join(queue_dir, f'{time.strftime("%Y%m%d-%H%M%S")}_{worker_id().replace(":", "_")}_{function}')
+    for sub_dir in ['tasks', 'claims', 'results']:
+        os.makedirs(os.path.join(job_dir, sub_dir), exist_ok=True)
+    for t, args in enumerate(task_args):
+        atomic_save(lambda f: pickle.dump({'module': module, 'function': function, 'args': args}, f, protocol=pickle.HIGHEST_PROTOCOL),
+                    os.path.join(job_dir, 'tasks', f'{t:06d}.pkl'))
+    # written last, workers only pick up jobs whose tasks are all written
+    job = {'code': loaded_code_version(), 'cwd': os.getcwd(), 'num_tasks': len(task_args), 'coordinator': worker_id()}
+    atomic_save(lambda f: json.dump(job, f), os.path.join(job_dir, 'job.json'), 'w')
+    return job_dir
+
+
+def claim_task(job_dir, task):
+    """
+    Claims a task for this process, recovering the claim of a dead worker.
+
+    Returns:
+        bool: True when this process holds the claim and the task has no result yet.
+    """
+    claim_path = os.path.join(job_dir, 'claims', f'{task}.json')
+    for _ in range(2):
+        try:
+            fd = os.open(claim_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stale = time.time() - os.stat(claim_path).st_mtime > queue_stale_seconds
+            except FileNotFoundError:
+                continue
+            if not stale:
+                return False
+            # the rename to a name of this worker is the recovery point: whatever claim it moved is
+            # checked again, so a claim another worker created after recovering it first is restored
+            stale_path = f'{claim_path}.{worker_id().replace(":", "_")}.stale'
+            try:
+                os.rename(claim_path, stale_path)
+            except FileNotFoundError:
+                return False
+            if time.time() - os.stat(stale_path).st_mtime <= queue_stale_seconds:
+                # link does not replace a claim created meanwhile, unlike rename
+                with contextlib.suppress(FileExistsError):
+                    os.link(stale_path, claim_path)
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+            print(f"Recovered stale claim of task {task} in {os.path.basename(job_dir)}")
+            continue
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': worker_id(), 'claimed': time.time()}, f)
+        if os.path.exists(os.path.join(job_dir, 'results', f'{task}.pkl')):
+            release_task(job_dir, task)
+            return False
+        return True
+    return False
+
+
+def release_task(job_dir, task):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(job_dir, 'claims', f'{task}.json'))
+
+
+@contextlib.contextmanager
+def heartbeat(job_dir, task):
+    """Touches the claim of a running task every queue_heartbeat_seconds, so it is not recovered as stale."""
+    claim_path = os.path.join(job_dir, 'claims', f'{task}.json')
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(queue_heartbeat_seconds):
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(claim_path)
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_task(job_dir, task, cwd):
+    """Runs a claimed task in the working directory of its job and writes its result, or the traceback if it raises."""
+    with open(os.path.join(job_dir, 'tasks', f'{task}.pkl'), 'rb') as f:
+        descriptor = pickle.load(f)
+    previous_cwd = os.getcwd()
+    with heartbeat(job_dir, task):
+        try:
+            os.chdir(cwd)
+            result = {'value': getattr(importlib.import_module(descriptor['module']), descriptor['function'])(*descriptor['args'])}
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        finally:
+            os.chdir(previous_cwd)
+        result['worker'] = worker_id()
+        atomic_save(lambda f: pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL), os.path.join(job_dir, 'results', f'{task}.pkl'))
+    release_task(job_dir, task)
+
+
+def pending_tasks(job_dir):
+    """Tasks of a job without a result, in task order."""
+    results = set(os.listdir(os.path.join(job_dir, 'results')))
+    return [file_name[:-4] for file_name in sorted(os.listdir(os.path.join(job_dir, 'tasks'))) if file_name not in results]
+
+
+def work_on_job(job_dir, max_tasks=None):
+    """
+    Claims and runs pending tasks of one job until none can be claimed.
+
+    Returns:
+        int: Number of tasks run, 0 as well when the job has been removed meanwhile or was
+            submitted by another code version.
+    """
+    num_run = 0
+    try:
+        with open(os.path.join(job_dir, 'job.json'), 'r') as f:
+            job = json.load(f)
+        if job['code'] != loaded_code_version():
+            return 0
+        for task in pending_tasks(job_dir):
+            if max_tasks is not None and num_run >= max_tasks:
+                break
+            if claim_task(job_dir, task):
+                run_task(job_dir, task, job['cwd'])
+                num_run += 1
+    except FileNotFoundError:
+        pass
+    return num_run
+
+
+def run_worker(queue_dir=queue_dir, idle_timeout=None, poll_seconds=1.0):
+    """
+    Runs the tasks of every job in the queue directory, oldest job first.
+
+    Args:
+        idle_timeout (float): Seconds without a claimable task after which the worker exits, None to wait for jobs forever.
+    """
+    idle_since = time.time()
+    while idle_timeout is None or time.time() - idle_since < idle_timeout:
+        jobs = sorted(os.listdir(queue_dir)) if os.path.isdir(queue_dir) else []
+        if sum(work_on_job(os.path.join(queue_dir, job)) for job in jobs if os.path.isdir(os.path.join(queue_dir, job))):
+            idle_since = time.time()
+        else:
+            time.sleep(poll_seconds)
+
+
+def remove_job(job_dir):
+    """Removes a job directory, workers stop picking up the job once its job.json is gone."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(job_dir, 'job.json'))
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def wait_for_job(job_dir, work=True, poll_seconds=1.0):
+    """
+    Yields the results of a job in task order as they arrive, independent of which worker ran a task
+    and when, and removes the job directory after the last one.
+
+    Args:
+        work (bool): Also claim and run tasks in this process while waiting.
+    """
+    tasks = [file_name[:-4] for file_name in sorted(os.listdir(os.path.join(job_dir, 'tasks')))]
+    try:
+        for t, task in enumerate(tasks):
+            result_path = os.path.join(job_dir, 'results', f'{task}.pkl')
+            while not os.path.exists(result_path):
+                if not (work and work_on_job(job_dir, max_tasks=1)):
+                    time.sleep(poll_seconds)
+            with open(result_path, 'rb') as f:
+                result = pickle.load(f)
+            if 'error' in result:
+                raise RuntimeError(f"Task {task} of {os.path.basename(job_dir)} failed on {result['worker']}:\n{result['error']}")
+            if t == len(tasks) - 1:
+                remove_job(job_dir)
+            yield result['value']
+    finally:
+        remove_job(job_dir)
+
+
+def run_queued(module, function, task_args, queue_dir=queue_dir):
+    """Runs module.function(*args) for every argument tuple through the work queue, yielding the results in order."""
+    if task_args:
+        yield from wait_for_job(submit_job(module, function, task_args, queue_dir))
@@ -0,0 +1,98 @@
+from config import *
+import pandas as pd
+import glob,hashlib,json,os,pickle,sqlite3,time
+from utils.cache_utils import file_fingerprint, source_hash
+from utils.stat_utils import zone_mask_source
+from utils.trace_utils import span
+
+_package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_schema_version = 2 # version of the results table layout
+
+def code_version():
+    """Hash of every Python source of the analysis, so any code change starts new results."""
+    return source_hash(sorted(glob.glob(os.path.join(_package_dir, '*.py')) + glob.glob(os.path.join(_package_dir, 'utils', '*.py'))))
+
+
+def results_key(localised_level, zone_config, patient_ids):
+    """
+    Identifies the inputs and code version the results of one level and zone configuration are computed from.
+
+    That is the code version, the settings, threshold grid and readers of config.py, the contents of the rules
+    and zone configuration files, and the fingerprints of the reports and of every patient's zone and lesion masks.
+
+    Returns:
+        str: Hash of the inputs.
+    """
+    settings = {
+        'sampling_mode': sampling_mode, 'sampling_seed': sampling_seed, 'sample_times': sample_times,
+        'num_ci_iter': num_ci_iter, 'bootstrap_mode': bootstrap_mode, 'bootstrap_unit': bootstrap_unit,
+        'ccl_flag': ccl_flag, 'total_cancer_defs': total_cancer_defs, 'excluded_pids': excluded_pids,
+        'pirads_thresholds': pirads_thresholds, 'iou_thresholds': [float(x) for x in iou_thresholds], 'readers': readers,
+    }
+    configs = {}
+    for file_path in [rules_file, 'zone_config.yml']:
+        with open(file_path, 'rb') as f:
+            configs[file_path] = hashlib.sha1(f.read()).hexdigest()
+    source_files = [mri_report_dir]
+    source_files += sorted(os.path.join(tpm_report_dir, file_name) for file_name in os.listdir(tpm_report_dir) if file_name.endswith('.csv'))
+    for pid in patient_ids:
+        source_files += [zone_mask_source(pid, zone_config, localised_level), zone_mask_source(pid, zone_config)]
+        source_files += [os.path.join(nii_dir, pid, lesion_file) for lesion_file, _ in readers.values()]
+    sources = [file_fingerprint(file_path) if os.path.exists(file_path) else file_path for file_path in source_files]
+    key = {'code': code_version(), 'settings': settings, 'configs': configs, 'level': localised_level, 'zone_config': zone_config, 'sources': sources}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def patient_level_key(key):
+    """Results key of the patient-level rows computed from the same inputs as the zone-level rows of a results key."""
+    return f'{key}-patient'
+
+
+def open_results_store(db_path=results_db):
+    """
+    Opens the SQLite results store, every computed row is committed as soon as it is added.
+
+    Args:
+        db_path (str): Database file, None for an in-memory store that is not kept between runs.
+    """
+    if db_path is not None and os.path.dirname(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path if db_path is not None else ':memory:')
+    # rows of an older table layout can not be reused, their code version differs anyway
+    if conn.execute("PRAGMA user_version").fetchone()[0] != _schema_version:
+        conn.execute("DROP TABLE IF EXISTS results")
+        conn.execute(f"PRAGMA user_version = {_schema_version}")
+    conn.execute("""CREATE TABLE IF NOT EXISTS results (
+        results_key TEXT, localised_level INTEGER, zone_config TEXT, pirads_thre REAL, iou_thre REAL,
+        reader TEXT, definition TEXT, row_order INTEGER, log_dict BLOB, created REAL,
+        PRIMARY KEY (results_key, pirads_thre, iou_thre, reader, definition))""")
+    conn.commit()
+    return conn
+
+
+def store_row(conn, key, localised_level, zone_config, pirads_thre, iou_thre, reader, cancer_def, row_order, log_dict):
+    """Commits one grid cell, log_dict None for a definition evaluate_definition skipped."""
+    conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (key, localised_level, zone_config, float(pirads_thre), float(iou_thre), reader, cancer_def, row_order,
+                  pickle.dumps(log_dict, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+    conn.commit()
+
+
+def stored_cells(conn, key):
+    """The (pirads_thre, iou_thre, reader, definition) cells already stored under a results key."""
+    rows = conn.execute("SELECT pirads_thre, iou_thre, reader, definition FROM results WHERE results_key = ?", (key,))
+    return set(rows)
+
+
+def stored_log_dicts(conn, key):
+    """Stored log dicts of a results key in grid order, without the skipped definitions."""
+    rows = conn.execute("SELECT log_dict FROM results WHERE results_key = ? ORDER BY row_order", (key,))
+    return [log_dict for log_dict in (pickle.loads(row[0]) for row in rows) if log_dict is not None]
+
+
+def export_results_excel(conn, key, filename):
+    """Writes the stored rows of a results key to the Excel table of the analysis."""
+    df = pd.DataFrame(stored_log_dicts(conn, key))
+    with span('excel_export'):
+        df.to_excel(filename, index=False)
+    print(f"Saved results to {filename}")
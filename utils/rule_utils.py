@@ -0,0 +1,62 @@
+import numpy as np
+import ast,functools
+
+bool_ops = {ast.And: np.logical_and, ast.Or: np.logical_or}
+bin_ops = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide}
+compare_ops = {
+    ast.Gt: np.greater, ast.GtE: np.greater_equal,
+    ast.Lt: np.less, ast.LtE: np.less_equal,
+    ast.Eq: np.equal, ast.NotEq: np.not_equal,
+}
+
+def compile_expression(node):
+    """Compiles a whitelisted expression node into a function of a dict of arrays."""
+    if isinstance(node, ast.BoolOp) and type(node.op) in bool_ops:
+        op, values = bool_ops[type(node.op)], [compile_expression(v) for v in node.values]
+        return lambda data: functools.reduce(op, [v(data) for v in values])
+    if isinstance(node, ast.Compare):
+        # chained comparisons such as 3<=gg1<5 are the conjunction of their pairs
+        terms = [compile_expression(v) for v in [node.left] + node.comparators]
+        ops = [compare_ops[type(op)] for op in node.ops]
+        return lambda data: functools.reduce(np.logical_and, [op(left(data), right(data)) for op, left, right in zip(ops, terms[:-1], terms[1:])])
+    if isinstance(node, ast.BinOp) and type(node.op) in bin_ops:
+        op, left, right = bin_ops[type(node.op)], compile_expression(node.left), compile_expression(node.right)
+        return lambda data: op(left(data), right(data))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.Not)):
+        op, operand = (np.negative if isinstance(node.op, ast.USub) else np.logical_not), compile_expression(node.operand)
+        return lambda data: op(operand(data))
+    if isinstance(node, ast.Name):
+        return lambda data: data[node.id]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return lambda data: node.value
+    raise ValueError(f"Unsupported expression in rules: {ast.unparse(node)}")
+
+
+def compile_criteria(criteria):
+    """Parses a rules.yml criteria string into a vectorised predicate, without eval."""
+    return compile_expression(ast.parse(criteria, mode='eval').body)
+
+
+def compile_definitions(rules, cancer_defs):
+    """Compiles the rules of every cancer definition into (predicate, result) pairs."""
+    return {cancer_def: [(compile_criteria(rule['criteria']), int(rule['result'])) for rule in rules['cancer_definition'][cancer_def]]
+            for cancer_def in cancer_defs}
+
+
+def evaluate_definitions(compiled_defs, data):
+    """
+    Evaluates all compiled definitions over arrays of the same shape.
+
+    Returns:
+        np.ndarray: Results with a trailing definition axis. The first matching rule gives
+            the result of an element, -99 if no rule matches.
+    """
+    shape = np.broadcast_shapes(*[np.shape(v) for v in data.values()])
+    res = np.full(shape + (len(compiled_defs),), -99, dtype=np.int8)
+    for d, rules in enumerate(compiled_defs.values()):
+        undecided = np.ones(shape, dtype=bool)
+        for predicate, result in rules:
+            match = undecided & predicate(data)
+            res[..., d][match] = result
+            undecided &= ~match
+    return res
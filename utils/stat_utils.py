@@ -1,17 +1,10 @@
 from config import *
 import pandas as pd
 import nibabel as nib
-import yaml,os
-
-def get_res_from_rules(rules, data_dict):
-    """get diagnostic result from different definitions"""
-    res = -99
-    for rule in rules:
-        if eval(rule['criteria'], data_dict):
-            res = rule['result']
-            break
-    return res
-
+import yaml,os,json,warnings
+from utils.cache_utils import file_fingerprint, find_zone_mask, zone_mask_path, read_label_array, load_label_volume, load_sparse_labels, sparse_labels, load_cached_pickle, save_array_dir, load_array_dir
+from utils.rule_utils import compile_definitions, evaluate_definitions
+from utils.trace_utils import traced
 
 def load_patient_ids():
     """Load and filter patient IDs from the image directory."""
@@ -20,113 +13,397 @@ def load_patient_ids():
     return patient_ids
 
 
-def load_mri_report(patient_ids):
-    """Load and process MRI report data."""
+def row_index(ids):
+    """Maps every ID of a sorted column to the (start, stop) rows holding it."""
+    return {pid: (int(rows[0]), int(rows[-1]) + 1) for pid, rows in ids.groupby(ids, sort=False).indices.items()}
+
+
+@traced('report_loading')
+def build_report_tables():
+    """Reads the MRI report and every template biopsy CSV into tables sorted and indexed by patientID."""
     mri_df = pd.read_excel(mri_report_dir)
+    mri_df = mri_df.sort_values('patientID', kind='stable').reset_index(drop=True)
+
+    tpm_frames = {file_name[:-len('.csv')]: pd.read_csv(os.path.join(tpm_report_dir, file_name))
+                  for file_name in sorted(os.listdir(tpm_report_dir)) if file_name.endswith('.csv')}
+    tpm_df = pd.concat([df.assign(patientID=pid) for pid, df in tpm_frames.items()], ignore_index=True) if tpm_frames else pd.DataFrame({'patientID': []})
+    return {
+        'mri': mri_df,
+        'mri_index': row_index(mri_df['patientID']),
+        'tpm': tpm_df,
+        'tpm_index': row_index(tpm_df['patientID']),
+        'tpm_dtypes': {pid: df.dtypes for pid, df in tpm_frames.items()}, # to restore each CSV as read
+    }
+
+
+_report_tables = None
+_report_sources = None # fingerprints of the source spreadsheets _report_tables was loaded from
+
+def load_report_tables(refresh=False):
+    """
+    Loads the indexed report tables once per process, through the report cache when it is enabled.
+
+    Args:
+        refresh (bool): Reload them if a source spreadsheet changed since they were loaded, at the start of
+            an analysis pass of a process that may outlive its inputs, such as a queue worker.
+    """
+    global _report_tables, _report_sources
+    if _report_tables is None or refresh:
+        source_files = [mri_report_dir] + sorted(os.path.join(tpm_report_dir, file_name) for file_name in os.listdir(tpm_report_dir) if file_name.endswith('.csv'))
+        sources = [file_fingerprint(file_path) for file_path in source_files]
+        if _report_tables is None or sources != _report_sources:
+            _report_tables = load_cached_pickle(report_cache_file, source_files, build_report_tables)
+            _report_sources = sources
+    return _report_tables
+
+
+def load_mri_report(patient_ids, report_column='les_all'):
+    """Load and process MRI report data, the lesion PI-RADS scores of one reader from its report column."""
+    tables = load_report_tables()
 
     # get cancer significance from MRI report
     mri_dict = {}
     for pid in patient_ids:
-        mri_data = mri_df[mri_df['patientID'] == pid]
-        if mri_data.empty:
+        if pid not in tables['mri_index']:
             print(f"Error: {pid} not found in MRI report.")
             continue
         else:
-            sig = [i for i in mri_data['les_all'].values if not pd.isna(i)]
+            start, stop = tables['mri_index'][pid]
+            mri_data = tables['mri'].iloc[start:stop]
+            sig = [i for i in mri_data[report_column].values if not pd.isna(i)]
         mri_dict[pid] = sig
     return mri_dict
 
 
+def load_mri_reports(patient_ids):
+    """load_mri_report of every reader, keyed by reader name, from report tables refreshed once for all of them."""
+    load_report_tables(refresh=True)
+    return {reader: load_mri_report(patient_ids, report_column) for reader, (_, report_column) in readers.items()}
+
+
 def load_tpm_data(pid):
     """Load template biopsy data for a given patientID."""
     tpm = None
-    tpm_report = os.path.join(tpm_report_dir, f'{pid.upper()}.csv')
+    tables = load_report_tables()
 
-    if os.path.exists(tpm_report):
-        tpm = pd.read_csv(tpm_report)
+    if pid.upper() in tables['tpm_index']:
+        start, stop = tables['tpm_index'][pid.upper()]
+        dtypes = tables['tpm_dtypes'][pid.upper()]
+        tpm = tables['tpm'].iloc[start:stop][dtypes.index].astype(dtypes).reset_index(drop=True)
     if tpm is None:
         print(f"Cannot find CSV for patient {pid}")
     return tpm
 
 
-def get_tpm_cancer_info(tpm, cancer_def_rules):
-    """Extract cancer information from template biopsy based on rules."""
-    zone_wc_values = tpm[tpm['zprescancer'] == 1]['zone_id']
-    t_zone_wc = [int(v) for v in zone_wc_values.values if not pd.isna(v)]
+@traced('rule_evaluation')
+def get_tpm_cancer_tensor(patient_ids, cancer_defs, rules, num_zones=20):
+    """
+    Evaluates every cancer definition on every biopsy zone of every patient at once.
 
-    t_cancer_info = {}
-    for zone in t_zone_wc:
-        cancer_dict = {
-            'gg1': tpm[tpm['zone_id'] == zone]['zprimgleason'].values[0] if not pd.isna(tpm[tpm['zone_id'] == zone]['zprimgleason'].values[0]) else -99,
-            'gg2': tpm[tpm['zone_id'] == zone]['zsecondgleason'].values[0] if not pd.isna(tpm[tpm['zone_id'] == zone]['zsecondgleason'].values[0]) else -99,
-            'ccl': tpm[tpm['zone_id'] == zone][f'maxcc{ccl_flag}'].values[0] if not pd.isna(tpm[tpm['zone_id'] == zone][f'maxcc{ccl_flag}'].values[0]) else -99,
-        }
-        t_cancer_info[zone] = get_res_from_rules(cancer_def_rules, cancer_dict)
-    return t_zone_wc, t_cancer_info
+    gg1, gg2 and ccl are gathered into patients x zones arrays from the first row of each
+    zone_id (missing values as -99) and the compiled rules are evaluated over them in one go.
+
+    Returns:
+        tensor (np.ndarray): patients x zones x definitions results (1 cancer, 0 not cancer, -99 no rule).
+        zone_wc (dict): Zones with zprescancer == 1 in TPM row order per patientID, None without TPM data.
+    """
+    tables = load_report_tables()
+    tpm_df = tables['tpm']
+    zone_wc = {}
+    for pid in patient_ids:
+        if pid.upper() not in tables['tpm_index']:
+            zone_wc[pid] = None
+            continue
+        start, stop = tables['tpm_index'][pid.upper()]
+        zone_wc_values = tpm_df['zone_id'].values[start:stop][tpm_df['zprescancer'].values[start:stop] == 1]
+        zone_wc[pid] = [int(v) for v in zone_wc_values if not pd.isna(v)]
+
+    patient_index = {pid.upper(): p for p, pid in enumerate(patient_ids)}
+    zone_rows = tpm_df[tpm_df['zone_id'].notna() & tpm_df['patientID'].isin(patient_index)]
+    zone_rows = zone_rows.drop_duplicates(['patientID', 'zone_id'], keep='first')
+    p_idx = zone_rows['patientID'].map(patient_index).values.astype(int)
+    z_idx = zone_rows['zone_id'].values.astype(int) - 1
+    num_zones = max(num_zones, int(z_idx.max(initial=-1)) + 1)
+
+    data = {}
+    for name, column in [('gg1', 'zprimgleason'), ('gg2', 'zsecondgleason'), ('ccl', f'maxcc{ccl_flag}')]:
+        data[name] = np.full((len(patient_ids), num_zones), -99.)
+        data[name][p_idx, z_idx] = zone_rows[column].fillna(-99).values
+    tensor = evaluate_definitions(compile_definitions(rules, cancer_defs), data)
+    return tensor, zone_wc
+
+
+def zone_mask_source(pid, zone_config, localised_level=20):
+    """The file holding a zone mask in whichever format it was written, the default per-level path when there is none."""
+    found = find_zone_mask(nii_dir, pid, zone_config, localised_level)
+    return found[0] if found is not None else zone_mask_path(nii_dir, pid, zone_config, localised_level)
 
 
 def load_localised_mask(pid, zone_config, localised_level=20):
-    """Load zone masks for a given patient and localised level."""
-    file_path = os.path.join(nii_dir, pid, f'gland_zone_{localised_level}level_{zone_config}.nii.gz')
-    if os.path.exists(file_path):
-        return nib.load(file_path).get_fdata()
+    """Load zone masks for a given patient and localised level, from a per-level or combined zone mask file."""
+    found = find_zone_mask(nii_dir, pid, zone_config, localised_level)
+    if found is not None:
+        return read_label_array(*found)
     return None
 
 
-def load_mri_lesion_mask(pid):
+def load_mri_lesion_mask(pid, lesion_file='lesion_a1.nii.gz'):
     """Load MRI lesion mask. Default using a1 mask."""
-    file_path = os.path.join(nii_dir, pid, 'lesion_a1.nii.gz')
+    file_path = os.path.join(nii_dir, pid, lesion_file)
     if os.path.exists(file_path):
         return nib.load(file_path).get_fdata()
     return None
 
 
+@traced('load_volume')
+def load_volume(file_path, volume=None):
+    """
+    Load a label volume as (data, offset, shape), through the volume cache when it is enabled.
+
+    Without a cache the full volume is returned with a zero offset.
+
+    Args:
+        volume (int): Volume of a 4D file, None for a 3D file.
+    """
+    if not os.path.exists(file_path):
+        return None
+    if volume_cache_dir is not None:
+        return load_label_volume(file_path, volume_cache_dir, volume)
+    arr = read_label_array(file_path, volume)
+    return arr, (0, 0, 0), arr.shape
+
+
+def load_localised_volume(pid, zone_config, localised_level=20):
+    """Load zone masks for a given patient and localised level as a cropped label volume, from a per-level or combined zone mask file."""
+    found = find_zone_mask(nii_dir, pid, zone_config, localised_level)
+    if found is None:
+        return None
+    return load_volume(*found)
+
+
+def load_zone_counts(pid, zone_config, localised_level):
+    """
+    Load the Barzell x localised level voxel count table of a patient's zone masks from the
+    sidecar gen_localised_zones writes next to them, instead of decoding the Barzell zone mask.
+
+    Returns:
+        np.ndarray: Counts of shape (21, num_zones+1), None without a sidecar entry describing
+            the zone mask files on disk.
+    """
+    sidecar_path = os.path.join(nii_dir, pid, f'gland_zone_{zone_config}.json')
+    if not os.path.exists(sidecar_path):
+        return None
+    with open(sidecar_path, 'r') as f:
+        entry = json.load(f)['levels'].get(str(localised_level))
+    if entry is None or 'barzell_counts' not in entry:
+        return None
+    for key, level in [('mask', localised_level), ('barzell_mask', 20)]:
+        file_path = zone_mask_source(pid, zone_config, level)
+        if entry[key] is None or not os.path.exists(file_path) or entry[key] != file_fingerprint(file_path):
+            return None
+    return np.array(entry['barzell_counts'], dtype=np.intp)
+
+
+def load_gland_volume(pid):
+    """Load the gland mask as a label volume cropped to the gland bounding box."""
+    return load_volume(os.path.join(nii_dir, pid, 'gland.nii.gz'))
+
+
+def load_mri_lesion_volume(pid, lesion_file='lesion_a1.nii.gz'):
+    """Load MRI lesion mask as a cropped label volume. Default using a1 mask."""
+    return load_volume(os.path.join(nii_dir, pid, lesion_file))
+
+
+@traced('load_volume')
+def load_mri_lesion_sparse(pid, lesion_file='lesion_a1.nii.gz'):
+    """Load MRI lesion mask as sparse (indices, label_counts, shape) voxel lists per lesion, see sparse_labels. Default using a1 mask."""
+    file_path = os.path.join(nii_dir, pid, lesion_file)
+    if not os.path.exists(file_path):
+        return None
+    if volume_cache_dir is not None:
+        return load_sparse_labels(file_path, volume_cache_dir)
+    arr = np.rint(nib.load(file_path).get_fdata()).astype(np.intp)
+    return sparse_labels(arr, (0, 0, 0), arr.shape)
+
+
 def load_rules():
     """Loads rules from the rules.yml file."""
     return yaml.safe_load(open(rules_file))
 
 
-def calculate_iou_3d(lesion_mask, zone_mask, iou_thre=0.05):
+def calculate_overlap_counts(lesion_mask, zone_mask, num_zones=None):
+    """
+    Calculate the lesion x zone intersection table in a single pass over the voxels.
+
+    Args:
+        lesion_mask (np.ndarray): A 3D mask with lesions labeled from 1.
+        zone_mask (np.ndarray): A 3D mask with the same shape and zones labeled from 1.
+        num_zones (int): Minimum number of zone columns, defaults to the largest zone label.
+
+    Returns:
+    np.ndarray: Voxel counts of shape (num_les+1, num_zones+1), where row and column 0 hold
+        the background. Per-lesion and per-zone voxel counts are its row and column sums.
+    """
+    assert lesion_mask.shape == zone_mask.shape, "Masks must have the same shape"
+
+    lesion_labels = np.asarray(lesion_mask).astype(np.intp).ravel()
+    zone_labels = np.asarray(zone_mask).astype(np.intp).ravel()
+    num_les = int(lesion_labels.max(initial=0))
+    num_zones = max(num_zones or 0, int(zone_labels.max(initial=0)))
+
+    joint_labels = lesion_labels * (num_zones + 1) + zone_labels
+    counts = np.bincount(joint_labels, minlength=(num_les + 1) * (num_zones + 1))
+    return counts.reshape(num_les + 1, num_zones + 1)
+
+
+@traced('overlap_counts')
+def calculate_overlap_counts_cropped(lesion_volume, zone_volume, num_zones=None):
+    """
+    calculate_overlap_counts for two cropped (data, offset, shape) label volumes.
+
+    The labelled intersection is counted on the overlap of the two crops only, and the
+    background row and column are restored from the per-label counts of each crop.
+    """
+    lesion_data, lesion_offset, shape = lesion_volume
+    zone_data, zone_offset, zone_shape = zone_volume
+    assert tuple(shape) == tuple(zone_shape), "Masks must have the same shape"
+
+    lesion_counts = np.bincount(np.asarray(lesion_data).astype(np.intp).ravel(), minlength=1)
+    zone_counts = np.bincount(np.asarray(zone_data).astype(np.intp).ravel(), minlength=1)
+    num_les = len(lesion_counts) - 1
+    num_zones = max(num_zones or 0, len(zone_counts) - 1)
+    lesion_counts = np.pad(lesion_counts, (0, num_les + 1 - len(lesion_counts)))
+    zone_counts = np.pad(zone_counts, (0, num_zones + 1 - len(zone_counts)))
+
+    lo = np.maximum(lesion_offset, zone_offset)
+    hi = np.minimum(np.add(lesion_offset, lesion_data.shape), np.add(zone_offset, zone_data.shape))
+    counts = np.zeros((num_les + 1, num_zones + 1), dtype=np.intp)
+    if (hi > lo).all():
+        lesion_crop = lesion_data[tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, lesion_offset))]
+        zone_crop = zone_data[tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, zone_offset))]
+        counts = calculate_overlap_counts(lesion_crop, zone_crop, num_zones)
+        counts = np.pad(counts, ((0, num_les + 1 - counts.shape[0]), (0, 0)))
+
+    counts[1:, 0] = lesion_counts[1:] - counts[1:, 1:].sum(axis=1)
+    counts[0, 1:] = zone_counts[1:] - counts[1:, 1:].sum(axis=0)
+    counts[0, 0] = np.prod(shape) - counts[1:, :].sum() - counts[0, 1:].sum()
+    return counts
+
+
+def sparse_overlap_counts(lesions, zone_volume, num_zones=None, zone_counts=None):
+    """
+    calculate_overlap_counts for sparse lesions and a cropped (data, offset, shape) zone volume.
+
+    The zone labels are only gathered at the lesion voxels, so the cost scales with the lesion
+    size. The background row and column are restored from the per-label counts.
+
+    Args:
+        lesions (tuple): (indices, label_counts, shape) from sparse_labels.
+        zone_counts (np.ndarray): Voxel count of every zone label when already counted.
+    """
+    indices, lesion_counts, shape = lesions
+    zone_data, zone_offset, zone_shape = zone_volume
+    assert tuple(shape) == tuple(zone_shape), "Masks must have the same shape"
+
+    if zone_counts is None:
+        zone_counts = np.bincount(np.asarray(zone_data).astype(np.intp).ravel(), minlength=1)
+    num_les = len(lesion_counts) - 1
+    num_zones = max(num_zones or 0, len(zone_counts) - 1)
+    zone_counts = np.pad(zone_counts, (0, num_zones + 1 - len(zone_counts)))
+
+    coords = np.stack(np.unravel_index(indices, shape), axis=1) - np.asarray(zone_offset)
+    inside = ((coords >= 0) & (coords < zone_data.shape)).all(axis=1)
+    zone_labels = np.zeros(len(indices), dtype=np.intp)
+    zone_labels[inside] = np.asarray(zone_data)[tuple(coords[inside].T)].astype(np.intp)
+    lesion_labels = np.repeat(np.arange(num_les + 1), lesion_counts)
+    counts = np.bincount(lesion_labels * (num_zones + 1) + zone_labels, minlength=(num_les + 1) * (num_zones + 1)).reshape(num_les + 1, num_zones + 1)
+
+    counts[0, 1:] = zone_counts[1:] - counts[1:, 1:].sum(axis=0)
+    counts[0, 0] = np.prod(shape) - counts[1:, :].sum() - counts[0, 1:].sum()
+    return counts
+
+
+def iou_from_counts(overlap_counts):
+    """
+    Calculate the IoU of every lesion with every zone from the intersection table.
+
+    Returns:
+    np.ndarray: IoU of shape (num_les, num_zones) for lesion and zone labels starting from 1.
+    """
+    lesion_counts = overlap_counts.sum(axis=1, keepdims=True)
+    zone_counts = overlap_counts.sum(axis=0, keepdims=True)
+    union = lesion_counts + zone_counts - overlap_counts
+    iou = np.divide(overlap_counts, union, out=np.zeros(overlap_counts.shape), where=union != 0)
+    return iou[1:, 1:]
+
+
+def zones_over_iou(iou, iou_thre=0.05):
+    """Lists, for every lesion label, the zones whose IoU is above the threshold."""
+    return {les + 1: [int(zone) + 1 for zone in np.flatnonzero(iou[les] > iou_thre)] for les in range(iou.shape[0])}
+
+
+def calculate_iou_3d(lesion_mask, zone_mask, iou_thre=0.05, num_zones=None, return_counts=False):
     """
     Calculate the IoU of each zone with the binary mask in 3D.
     
     Args:
-        binary_mask (np.ndarray): A 3D binary mask with the same shape as zone_mask.
-        zone_mask (np.ndarray): A 3D mask with zones labeled from 1 to 20.
+        lesion_mask (np.ndarray): A 3D mask with lesions labeled from 1, same shape as zone_mask.
+        zone_mask (np.ndarray): A 3D mask with zones labeled from 1 to num_zones.
         iou_thre (float): IoU threshold to consider a zone as relevant.
+        num_zones (int): Number of zones, defaults to the largest zone label.
+        return_counts (bool): Also return the intersection table from calculate_overlap_counts.
     
     Returns:
-    dict: Dictionary where keys are zone labels and values are their IoU with the binary mask.
+    dict: Dictionary where keys are lesion labels and values are the zones with IoU above iou_thre.
     """
-    # Ensure masks have the same shape
-    assert lesion_mask.shape == zone_mask.shape, "Masks must have the same shape"
-   
-    num_les = int(np.max(lesion_mask))
-
-    iou_dict = {}
-    for les in range(1, num_les+1):
-        iou_dict[les] = []
-        for zone in range(1, 21):
-            binary_mask = (lesion_mask == les)
-            zone_mask_current = (zone_mask == zone)
-            
-            # Calculate intersection and union
-            intersection = np.logical_and(binary_mask, zone_mask_current).sum()
-            union = np.logical_or(binary_mask, zone_mask_current).sum()
-            
-            if union != 0:
-                iou = intersection / union
-            else:
-                iou = 0
-            
-            if iou > iou_thre:
-                iou_dict[les].append(zone)
-    
+    overlap_counts = calculate_overlap_counts(lesion_mask, zone_mask, num_zones)
+    iou_dict = zones_over_iou(iou_from_counts(overlap_counts), iou_thre)
+    if return_counts:
+        return iou_dict, overlap_counts
     return iou_dict
 
 
-def calculate_cm(tpm_les_all, mri_les_all):
-    """Calculates confusion matrix: True Positives, True Negatives, False Positives, False Negatives."""
+@traced('compact_rows')
+def compact_rows(mri_les_all, tpm_les_groups):
+    """
+    Compacts repeated samples into unique (MRI, TPM) rows.
+
+    Args:
+        mri_les_all (list): One MRI zone row per patient.
+        tpm_les_groups (list): One (samples, zones) TPM array per patient, in sample order.
+
+    Returns:
+    tuple: Compact MRI and TPM rows, and the index of the compact row of every sample, so that
+        mri[row_index] and tpm[row_index] are the full per-sample arrays.
+    """
+    mri_rows, tpm_rows, row_index = [], [], []
+    num_rows = 0
+    for mri_row, tpm_group in zip(mri_les_all, tpm_les_groups):
+        unique_rows, inverse = np.unique(tpm_group, axis=0, return_inverse=True)
+        mri_rows.append(np.repeat(np.asarray(mri_row)[None], len(unique_rows), axis=0))
+        tpm_rows.append(unique_rows)
+        row_index.append(inverse.reshape(-1) + num_rows)
+        num_rows += len(unique_rows)
+    num_zones = len(mri_les_all[0]) if len(mri_les_all) else 0
+    if num_rows == 0:
+        return np.zeros((0, num_zones)), np.zeros((0, num_zones)), np.zeros(0, dtype=np.intp)
+    return np.concatenate(mri_rows), np.concatenate(tpm_rows), np.concatenate(row_index)
+
+def cm_row_counts(tpm_les_all, mri_les_all):
+    """Calculates the TP, TN, FP and FN counts of every binary row, as an array of shape (rows, 4)."""
+    TP = np.sum((tpm_les_all == 1) & (mri_les_all == 1), axis=1)
+    TN = np.sum((tpm_les_all == 0) & (mri_les_all == 0), axis=1)
+    FP = np.sum((tpm_les_all == 0) & (mri_les_all == 1), axis=1)
+    FN = np.sum((tpm_les_all == 1) & (mri_les_all == 0), axis=1)
+    return np.stack([TP, TN, FP, FN], axis=1)
+
+def calculate_cm(tpm_les_all, mri_les_all, weights=None):
+    """Calculates confusion matrix: True Positives, True Negatives, False Positives, False Negatives.
+
+    weights optionally gives the (integer or fractional) multiplicity of every row.
+    """
+    if weights is not None:
+        return tuple(weights @ cm_row_counts(tpm_les_all, mri_les_all))
     TP = np.sum((tpm_les_all == 1) & (mri_les_all == 1))
     TN = np.sum((tpm_les_all == 0) & (mri_les_all == 0))
     FP = np.sum((tpm_les_all == 0) & (mri_les_all == 1))
@@ -141,45 +418,224 @@ def calculate_performance_metrics(TP, TN, FP, FN):
     NPV = TN / (TN + FN) if (TN + FN) > 0 else np.nan
     return sensitivity, specificity, PPV, NPV
 
-def bootstrap_confidence_intervals(mri_les_all, tpm_les_all, num_iterations=num_ci_iter):
-    """Calculates bootstrap confidence intervals for performance metrics."""
+def cm_contributions(tpm_les_all, mri_les_all):
+    """
+    Calculates the TP, TN, FP and FN counts contributed by every row.
+
+    tpm_les_all may hold probabilities of each zone being cancer positive, in which case the
+    contributions are the expected counts.
+
+    Returns:
+    np.ndarray: Counts of shape (rows, 4) in TP, TN, FP, FN order.
+    """
+    TP = np.sum(tpm_les_all * mri_les_all, axis=1)
+    TN = np.sum((1 - tpm_les_all) * (1 - mri_les_all), axis=1)
+    FP = np.sum((1 - tpm_les_all) * mri_les_all, axis=1)
+    FN = np.sum(tpm_les_all * (1 - mri_les_all), axis=1)
+    return np.stack([TP, TN, FP, FN], axis=1)
+
+def performance_metrics_batch(counts):
+    """Sensitivity, specificity, PPV and NPV of every row of (iterations, 4) TP, TN, FP, FN counts, NaN where undefined."""
+    TP, TN, FP, FN = np.moveaxis(np.asarray(counts, dtype=float), -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return [np.where(den > 0, num / den, np.nan) for num, den in [(TP, TP + FN), (TN, TN + FP), (TP, TP + FP), (TN, TN + FN)]]
+
+def patient_counts(row_counts, group_sizes):
+    """Sums the per-sample (samples, 4) counts over the consecutive samples of every patient."""
+    sample_patient = np.repeat(np.arange(len(group_sizes)), group_sizes)
+    counts = np.zeros((len(group_sizes), row_counts.shape[1]), dtype=row_counts.dtype)
+    np.add.at(counts, sample_patient, row_counts)
+    return counts
+
+def bootstrap_weights(rng, num_draws, unit_index, num_units, num_iter, mode):
+    """
+    Draws the resampling weights of num_iter bootstrap replicates.
+
+    Args:
+        num_draws (int): Number of resampled units per replicate.
+        unit_index (np.ndarray): Compact unit of every resampled unit, None if they are the units.
+        num_units (int): Number of compact units.
+        mode (str): 'compat' draws the indices rng.choice(num_draws, num_draws) draws in the per-replicate
+            loop, 'multinomial' draws the weights of the compact units directly.
+
+    Returns:
+    np.ndarray: Weights of shape (num_iter, num_units), each row summing to num_draws.
+    """
+    if mode == 'compat':
+        idx = rng.integers(0, num_draws, (num_iter, num_draws))
+        if unit_index is not None:
+            idx = unit_index[idx]
+        idx += np.arange(num_iter)[:, None] * num_units
+        return np.bincount(idx.ravel(), minlength=num_iter * num_units).reshape(num_iter, num_units)
+    if mode == 'multinomial':
+        multiplicity = np.ones(num_units) if unit_index is None else np.bincount(unit_index, minlength=num_units)
+        return rng.multinomial(num_draws, multiplicity / multiplicity.sum(), size=num_iter)
+    raise ValueError(f"Unknown bootstrap mode: {mode}")
+
+def bootstrap_metrics(unit_counts, unit_index, num_iterations, mode, chunk_elements):
+    """
+    Sensitivity, specificity, PPV and NPV of every bootstrap replicate, drawn as weight matrices times the count
+    matrix in chunks of at most chunk_elements drawn indices or weights.
+
+    Returns:
+    list: Four arrays of shape (iterations,) + unit_counts.shape[1:-1].
+    """
     rng = np.random.default_rng(seed=42)
-    sensitivities, specificities, PPVs, NPVs = [], [], [], []
+    num_units = unit_counts.shape[0]
+    num_draws = num_units if unit_index is None else len(unit_index)
+    chunk_iter = max(1, chunk_elements // max(num_draws if mode == 'compat' else num_units, 1))
+
+    metrics = [[], [], [], []]
+    for start in range(0, num_iterations, chunk_iter):
+        num_iter = min(chunk_iter, num_iterations - start)
+        weights = bootstrap_weights(rng, num_draws, unit_index, num_units, num_iter, mode)
+        for values, metric in zip(metrics, performance_metrics_batch(np.tensordot(weights, unit_counts, axes=1))):
+            values.append(metric)
+    return [np.concatenate(values) for values in metrics]
+
+@traced('bootstrap')
+def bootstrap_count_ci(unit_counts, unit_index=None, num_iterations=num_ci_iter, mode=bootstrap_mode, chunk_elements=bootstrap_chunk_elements):
+    """
+    Calculates bootstrap confidence intervals from the TP, TN, FP, FN counts of every resampling unit.
 
-    data_size = mri_les_all.shape[0]
+    All replicates are drawn as weight matrices times the count matrix, in chunks of at most
+    chunk_elements drawn indices or weights.
+
+    Args:
+        unit_counts (np.ndarray): Counts of shape (units, 4), e.g. per row or per patient.
+        unit_index (np.ndarray): Compact unit of every resampled row, None to resample the units themselves.
+        mode (str): See bootstrap_weights. 'compat' gives the results of the original seed-42 loop.
 
-    for _ in range(num_iterations):
-        idx = rng.choice(data_size, data_size, replace=True)
-        mri_les_all_sample = mri_les_all[idx]
-        tpm_les_all_sample = tpm_les_all[idx]
+    Returns:
+    tuple: 95% CIs of sensitivity, specificity, PPV and NPV.
+    """
+    return tuple(percentile_ci(values) for values in bootstrap_metrics(unit_counts, unit_index, num_iterations, mode, chunk_elements))
 
-        TP, TN, FP, FN = calculate_cm(tpm_les_all_sample, mri_les_all_sample)
-        sensitivity, specificity, PPV, NPV = calculate_performance_metrics(TP, TN, FP, FN)
+@traced('bootstrap')
+def bootstrap_count_ci_cells(unit_counts, num_iterations=num_ci_iter, mode=bootstrap_mode, chunk_elements=bootstrap_chunk_elements):
+    """
+    bootstrap_count_ci of many cells at once, e.g. every threshold pair and definition, all from the same
+    replicates of resampled units.
 
-        sensitivities.append(sensitivity)
-        specificities.append(specificity)
-        PPVs.append(PPV)
-        NPVs.append(NPV)
-    
-    # Remove NaNs in case of any invalid bootstrap samples (e.g., division by zero)
-    sensitivities = np.array(sensitivities)[~np.isnan(sensitivities)]
-    specificities = np.array(specificities)[~np.isnan(specificities)]
-    PPVs = np.array(PPVs)[~np.isnan(PPVs)]
-    NPVs = np.array(NPVs)[~np.isnan(NPVs)]
+    Args:
+        unit_counts (np.ndarray): Counts of shape (units, cells, 4).
+
+    Returns:
+    tuple: 95% CIs of sensitivity, specificity, PPV and NPV, each of shape (cells, 2) and equal to the
+        bootstrap_count_ci of every cell on its own.
+    """
+    with warnings.catch_warnings():
+        # cells without any defined replicate are left NaN, as percentile_ci does
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return tuple(np.nanpercentile(values, [2.5, 97.5], axis=0).T
+                     for values in bootstrap_metrics(unit_counts, None, num_iterations, mode, chunk_elements))
+
+def bootstrap_ci_from_contributions(contributions, draws_per_row=1, num_iterations=num_ci_iter):
+    """
+    Calculates bootstrap confidence intervals from per-row expected TP, TN, FP, FN counts of draws_per_row draws.
+
+    Every row stands for draws_per_row resampled rows of one draw each, the rows 'legacy' and 'sample'
+    sampling resample, so the CIs of expected counts are on the same resampling unit.
+    """
+    unit_index = np.repeat(np.arange(len(contributions)), draws_per_row)
+    return bootstrap_count_ci(contributions / draws_per_row, unit_index, num_iterations)
+
+def percentile_ci(values):
+    """95% confidence interval (2.5th and 97.5th percentiles) of bootstrap values, ignoring NaNs (NaN if all are)."""
+    values = np.array(values)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.array([np.nan, np.nan])
+    return np.percentile(values, [2.5, 97.5])
+
+def bootstrap_confidence_intervals(mri_les_all, tpm_les_all, num_iterations=num_ci_iter, row_index=None):
+    """Calculates bootstrap confidence intervals for performance metrics.
+
+    With compact rows from compact_rows, row_index maps every resampled row to its compact row,
+    which draws the same samples as the full arrays would.
+    """
+    return bootstrap_count_ci(cm_row_counts(tpm_les_all, mri_les_all), row_index, num_iterations)
+
+def roc_counts(scores, pos_weights, neg_weights, thresholds, strict=True):
+    """
+    Calculates TP, TN, FP and FN at every threshold in one sorted cumulative pass over the zone rows.
+
+    A zone row is called positive when its score is above the threshold (at or above it when not strict),
+    and counts pos_weights cancer-positive and neg_weights cancer-negative zones.
+
+    Args:
+        scores (np.ndarray): Score of every zone row, -inf for rows never called positive.
+        pos_weights (np.ndarray): Weights of shape (rows,), or (replicates, rows) for bootstrap replicates.
+        thresholds (np.ndarray): Thresholds in increasing order.
+
+    Returns:
+    np.ndarray: Counts of shape ([replicates,] thresholds, 4) in TP, TN, FP, FN order.
+    """
+    order = np.argsort(scores, kind='stable')
+    cut = np.searchsorted(scores[order], thresholds, side='right' if strict else 'left')
+    def called_positive(weights):
+        cum = np.cumsum(np.asarray(weights, dtype=float)[..., order], axis=-1)
+        cum = np.concatenate([np.zeros(cum.shape[:-1] + (1,)), cum], axis=-1)
+        return cum[..., -1:] - cum[..., cut], cum[..., -1:]
+    TP, num_pos = called_positive(pos_weights)
+    FP, num_neg = called_positive(neg_weights)
+    return np.stack([TP, num_neg - FP, FP, num_pos - TP], axis=-1)
+
+def roc_points(counts):
+    """
+    (FPR, TPR) of ROC curve counts from roc_counts, in increasing false positive rate order and closed
+    by the (0, 0) and (1, 1) end points. NaN where there are no cancer-negative or -positive zones.
+    """
+    TP, TN, FP, FN = np.moveaxis(np.asarray(counts, dtype=float), -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = (TP / (TP + FN))[..., ::-1]
+        fpr = (FP / (FP + TN))[..., ::-1]
+    end = np.ones(tpr.shape[:-1] + (1,))
+    return np.concatenate([0 * end, fpr, end], axis=-1), np.concatenate([0 * end, tpr, end], axis=-1)
+
+def roc_auc(counts):
+    """Trapezoidal area under the ROC curves of roc_counts, ties between zone scores counting half."""
+    fpr, tpr = roc_points(counts)
+    return np.sum(np.diff(fpr, axis=-1) * (tpr[..., 1:] + tpr[..., :-1]) / 2, axis=-1)
+
+@traced('bootstrap')
+def bootstrap_roc(scores, pos_weights, neg_weights, thresholds, row_unit, num_units, fpr_grid, strict=True,
+                  num_iterations=num_ci_iter, mode=bootstrap_mode, chunk_elements=bootstrap_chunk_elements):
+    """
+    Calculates the bootstrap CI of the AUC and the bootstrap bands of an ROC curve by resampling units,
+    e.g. patients, with all their zone rows. Every replicate is a weighted roc_counts pass.
 
-    # Calculate 95% confidence intervals (2.5th and 97.5th percentiles)
-    sens_ci = np.percentile(sensitivities, [2.5, 97.5])
-    spec_ci = np.percentile(specificities, [2.5, 97.5])
-    PPV_ci = np.percentile(PPVs, [2.5, 97.5])
-    NPV_ci = np.percentile(NPVs, [2.5, 97.5])
+    Args:
+        row_unit (np.ndarray): Unit of every zone row.
+        fpr_grid (np.ndarray): Increasing false positive rates the sensitivity bands are given at.
+        mode (str): See bootstrap_weights.
 
-    return sens_ci, spec_ci, PPV_ci, NPV_ci
+    Returns:
+    tuple: 95% CI of the AUC, and the 2.5th and 97.5th percentiles of the sensitivity at every fpr_grid rate.
+    """
+    rng = np.random.default_rng(seed=42)
+    chunk_iter = max(1, chunk_elements // max(len(scores), 1))
+    aucs, sensitivities = [], []
+    for start in range(0, num_iterations, chunk_iter):
+        num_iter = min(chunk_iter, num_iterations - start)
+        weights = bootstrap_weights(rng, num_units, None, num_units, num_iter, mode)[:, row_unit]
+        counts = roc_counts(scores, weights * pos_weights, weights * neg_weights, thresholds, strict)
+        aucs.append(roc_auc(counts))
+        fpr, tpr = roc_points(counts)
+        sensitivities.append(np.array([np.interp(fpr_grid, x, y) if not np.isnan(x).any() and not np.isnan(y).any() else np.full(len(fpr_grid), np.nan)
+                                       for x, y in zip(fpr, tpr)]))
+    sensitivities = np.concatenate(sensitivities)
+    with warnings.catch_warnings():
+        # fpr_grid rates without any defined replicate are left NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        band_lo, band_hi = np.nanpercentile(sensitivities, [2.5, 97.5], axis=0)
+    return percentile_ci(np.concatenate(aucs)), band_lo, band_hi
 
 
 def format_log_dict(log_dict):
     """Formats the numerical values in the log dictionary to percentages and adds CI strings."""
     for key in log_dict:
-        if key == 'iou_thre':
+        if key in ['iou_thre', 'TP', 'TN', 'FP', 'FN']:
             continue
         if isinstance(log_dict[key], float):
             log_dict[key] = round(log_dict[key] * 100, 2)
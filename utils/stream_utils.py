@@ -0,0 +1,119 @@
+from config import prefetch_depth, stream_max_volumes, stream_threads
+import collections,threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_end = object() # end of the streamed items
+
+class VolumeBudget:
+    """Counts the volumes held in memory, blocking whoever would take more than the cap."""
+    def __init__(self, max_volumes):
+        self.free = max_volumes
+        self._cond = threading.Condition()
+
+    def acquire(self, num_volumes, blocking=True, reserve=0):
+        """Takes num_volumes, leaving at least reserve free. Returns False instead of waiting when not blocking."""
+        with self._cond:
+            while self.free - num_volumes < reserve:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self.free -= num_volumes
+            return True
+
+    def release(self, num_volumes):
+        with self._cond:
+            self.free += num_volumes
+            self._cond.notify_all()
+
+
+class PatientStream:
+    """
+    Loads upcoming patients on background threads while the current one is processed, and
+    saves outputs on the same threads, holding at most max_volumes volumes in memory.
+
+    The loaded volumes of a patient count until the next patient is requested, a saved volume
+    until it is written. Patients are only loaded ahead while one volume stays free for saving,
+    so the consumer can always save. prefetch_depth 0 loads and saves serially in the caller.
+
+    Usage:
+        with PatientStream() as stream:
+            for pid, inputs in stream.stream(patient_ids, load_fn, num_volumes=3):
+                ...
+                stream.save(save_fn, output)
+    """
+    def __init__(self, prefetch_depth=prefetch_depth, max_volumes=stream_max_volumes, num_threads=stream_threads):
+        self.prefetch_depth = prefetch_depth
+        self.max_volumes = max_volumes
+        self._budget = VolumeBudget(max_volumes)
+        self._executor = ThreadPoolExecutor(max_workers=num_threads) if prefetch_depth > 0 else None
+
+    def stream(self, items, load_fn, num_volumes=1):
+        """
+        Generator of (item, load_fn(item)) in item order, loading up to prefetch_depth items ahead.
+
+        Args:
+            load_fn (callable): Loader run on a background thread, it should return its errors
+                rather than raise them, an exception ends the stream.
+            num_volumes (int): Volumes one loaded item holds in memory.
+        """
+        if self._executor is None:
+            for item in items:
+                yield item, load_fn(item)
+            return
+        if num_volumes + 1 > self.max_volumes:
+            raise ValueError(f"stream_max_volumes must hold the {num_volumes} loaded volumes of a patient and one saved volume, got {self.max_volumes}")
+
+        items = iter(items)
+        pending = collections.deque()
+        exhausted = False
+        try:
+            while True:
+                # the next item waits for volumes to be freed, items further ahead are only loaded when they fit
+                while not exhausted and len(pending) <= self.prefetch_depth:
+                    if not self._budget.acquire(num_volumes, blocking=not pending, reserve=1 if pending else 0):
+                        break
+                    item = next(items, _end)
+                    if item is _end:
+                        self._budget.release(num_volumes)
+                        exhausted = True
+                        break
+                    pending.append((item, self._executor.submit(load_fn, item)))
+                if not pending:
+                    return
+                item, future = pending[0]
+                yield item, future.result()
+                pending.popleft()
+                self._budget.release(num_volumes)
+        finally:
+            # volumes of the items still loaded ahead when the stream is left early
+            self._budget.release(num_volumes * len(pending))
+
+    def save(self, save_fn, *args, num_volumes=1):
+        """
+        Runs save_fn(*args) on a background thread, waiting while the volume cap is reached.
+
+        Returns:
+            Future: Completed once written, holding the error of a failed save.
+        """
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(save_fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        self._budget.acquire(num_volumes)
+        future = self._executor.submit(save_fn, *args)
+        future.add_done_callback(lambda _: self._budget.release(num_volumes))
+        return future
+
+    def close(self):
+        """Waits for every background save, their errors are left on the futures returned by save."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
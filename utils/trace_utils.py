@@ -0,0 +1,117 @@
+from config import trace_file
+import contextlib,functools,glob,json,os,resource,threading,time
+
+# Chrome trace format events recorded by this process
+_events = []
+_null_span = contextlib.nullcontext()
+
+def read_bytes():
+    """Bytes read by this process so far (Linux), None where unavailable."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+@contextlib.contextmanager
+def _span(name, args):
+    start_bytes = read_bytes()
+    start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        end_bytes = read_bytes()
+        # ru_maxrss is the peak of the whole process so far, only its rise is caused by this span
+        args = dict(args, peak_rss_rise_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_maxrss)
+        if start_bytes is not None and end_bytes is not None:
+            args['bytes_read'] = end_bytes - start_bytes
+        _events.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                        'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+
+def span(name, **args):
+    """
+    Records the wall time, bytes read and rise of the process peak RSS of a block as one trace event.
+
+    A shared no-op context when tracing is disabled (trace_file is None).
+    """
+    if trace_file is None:
+        return _null_span
+    return _span(name, args)
+
+
+def traced(name=None):
+    """Decorator recording every call of a function as a span, the function is returned unchanged when tracing is disabled."""
+    def decorator(fn):
+        if trace_file is None:
+            return fn
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _span(name or fn.__name__, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_event(name, **args):
+    """Records an instant event, e.g. a skipped patient, counted per name in the trace summary."""
+    if trace_file is None:
+        return
+    _events.append({'name': name, 'ph': 'i', 's': 'p', 'ts': time.perf_counter() * 1e6,
+                    'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+
+def flush_events():
+    """Appends the events of this process to a part file next to trace_file, for worker processes."""
+    if trace_file is None or not _events:
+        return
+    with open(f'{trace_file}.{os.getpid()}.part', 'a') as f:
+        for event in _events:
+            f.write(json.dumps(event) + '\n')
+    _events.clear()
+
+
+def summarise_events(events):
+    """Per-stage and per-patient totals of span events, and the number of every instant event."""
+    stages, patients, counts = {}, {}, {}
+    for event in events:
+        if event['ph'] == 'i':
+            counts[event['name']] = counts.get(event['name'], 0) + 1
+            continue
+        stage = stages.setdefault(event['name'], {'calls': 0, 'seconds': 0., 'bytes_read': 0, 'peak_rss_rise_kb': 0})
+        stage['calls'] += 1
+        stage['seconds'] += event['dur'] / 1e6
+        stage['bytes_read'] += event['args'].get('bytes_read', 0)
+        stage['peak_rss_rise_kb'] = max(stage['peak_rss_rise_kb'], event['args']['peak_rss_rise_kb'])
+        if 'pid' in event['args']:
+            patient = patients.setdefault(event['args']['pid'], {})
+            patient[event['name']] = patient.get(event['name'], 0.) + event['dur'] / 1e6
+    return {'stages': stages, 'patients': patients, 'counts': counts}
+
+
+def write_trace():
+    """
+    Writes the events of this process and of flushed worker processes to trace_file.
+
+    The file is a Chrome trace (chrome://tracing, Perfetto) whose otherData holds the per-stage
+    calls, seconds, bytes read and largest rise of the process peak RSS during one call, the per-patient
+    seconds and the event counts.
+    """
+    if trace_file is None:
+        return
+    events = list(_events)
+    _events.clear()
+    for part_file in sorted(glob.glob(f'{glob.escape(trace_file)}.*.part')):
+        with open(part_file, 'r') as f:
+            events += [json.loads(line) for line in f if line.strip()]
+        os.remove(part_file)
+    events.sort(key=lambda event: event['ts'])
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': summarise_events(events)}, f)
+    print(f"Saved trace to {trace_file}")
@@ -0,0 +1,202 @@
+# zone_config_sweep.py
+import pandas as pd
+import numpy as np
+import yaml,os,io,random,itertools,contextlib
+import tqdm
+from config import *
+from gen_localised_zones import get_zone_lim
+from localised_analysis import get_level_config, calculate_ratio_from_counts, get_patient_tpm_zones, collect_patient_rows, evaluate_definition, reader_log_dict
+from utils.stat_utils import *
+from utils.zone_utils import zone_edges, edges_lut, cumulative_counts, cell_counts
+from utils.trace_utils import span, count_event, write_trace
+from utils.stream_utils import PatientStream
+
+def zone_config_candidates(base_config, zone_config_grid):
+    """
+    Applies every combination of the grid values over a zone_config.yml configuration.
+
+    Returns:
+        list: (name, params, config) of every candidate, name listing its grid values.
+    """
+    keys = list(zone_config_grid)
+    candidates = []
+    for values in itertools.product(*[zone_config_grid[key] for key in keys]):
+        params = dict(zip(keys, values))
+        name = ','.join(f"{key}={value}" for key, value in params.items())
+        candidates.append((name, params, dict(base_config, **params)))
+    return candidates
+
+
+def load_patient_geometry(pid):
+    """
+    Loads what labelling any zone configuration needs of one patient.
+
+    That is the gland bounding box, the summed-volume table of the gland mask and, for every lesion
+    label of every reader, the summed-volume table of its gland voxels over their own bounding box
+    and its total voxel count.
+
+    Returns:
+        dict: Patient geometry, None for the patients gen_localised_zones skips (no T2 image or gland mask).
+    """
+    if not os.path.exists(os.path.join(nii_dir, pid, 't2.nii.gz')):
+        return None
+    gland_volume = load_gland_volume(pid)
+    if gland_volume is None or gland_volume[0].size == 0:
+        return None
+    gland_data, gland_offset, shape = gland_volume
+    lo = np.array(gland_offset)
+    hi = lo + gland_data.shape
+    gland = np.asarray(gland_data) > 0.
+    return {
+        'shape': tuple(shape),
+        'lo': lo,
+        'hi': hi,
+        'bbox': (lo[0], hi[0] - 1, lo[1], hi[1] - 1, lo[2], hi[2] - 1),
+        'gland': cumulative_counts(gland),
+        'readers': {reader: lesion_geometry(load_mri_lesion_sparse(pid, lesion_file), gland, lo, hi) for reader, (lesion_file, _) in readers.items()},
+    }
+
+
+def lesion_geometry(lesions, gland, lo, hi):
+    """
+    Summed-volume table of the gland voxels of every lesion label over the bounding box of those voxels,
+    with the box offset, and the voxel count of every label, see load_patient_geometry.
+    """
+    tables, lesion_counts = [], np.zeros(1, dtype=np.intp)
+    if lesions is not None:
+        indices, lesion_counts, shape = lesions
+        coords = np.stack(np.unravel_index(indices, shape), axis=1)
+        for label_coords in np.split(coords, np.cumsum(lesion_counts)[:-1])[1:]:
+            local = label_coords - lo
+            local = local[((local >= 0) & (local < hi - lo)).all(axis=1)]
+            local = local[gland[tuple(local.T)]]
+            les_lo = local.min(axis=0) if len(local) else np.zeros(3, dtype=np.intp)
+            mask = np.zeros(local.max(axis=0) - les_lo + 1 if len(local) else (1, 1, 1), dtype=bool)
+            mask[tuple((local - les_lo).T)] = True
+            tables.append((lo + les_lo, cumulative_counts(mask)))
+    return {'lesions': tables, 'lesion_counts': lesion_counts}
+
+
+def label_counts(lut, cum, offset, edges, num_labels):
+    """Voxel counts of a summed-volume table per zone label of the cells between the edges."""
+    return np.bincount(lut.ravel(), weights=cell_counts(cum, offset, edges).ravel(), minlength=num_labels).astype(np.intp)
+
+
+def zone_sweep_features(pid, geometry, zone_config, localised_level, num_zones, mri_dicts, tpm, tpm_zone_map_config):
+    """
+    extract_patient_features for a zone configuration labelled in memory from the patient geometry.
+
+    The zone boxes cut the gland bounding box into cells of one zone label each, so every voxel
+    count is a sum of summed-volume table corners, giving the tables of the written zone masks.
+    """
+    zone_lim = get_zone_lim(zone_config, localised_level, geometry['bbox'])
+    edges = zone_edges(zone_lim, geometry['lo'], geometry['hi'])
+    lut = edges_lut(zone_lim, edges)
+
+    zone_counts = label_counts(lut, geometry['gland'], geometry['lo'], edges, num_zones + 1)
+
+    reader_features = {}
+    for reader, lesions in geometry['readers'].items():
+        overlap_counts = np.zeros((len(lesions['lesion_counts']), num_zones + 1), dtype=np.intp)
+        for label, (les_lo, cum) in enumerate(lesions['lesions'], start=1):
+            overlap_counts[label] = label_counts(lut, cum, les_lo, edges, num_zones + 1)
+        overlap_counts[0, 1:] = zone_counts[1:] - overlap_counts[1:, 1:].sum(axis=0)
+        overlap_counts[1:, 0] = lesions['lesion_counts'][1:] - overlap_counts[1:, 1:].sum(axis=1)
+        overlap_counts[0, 0] = np.prod(geometry['shape']) - overlap_counts[1:, :].sum() - overlap_counts[0, 1:].sum()
+        reader_features[reader] = {
+            "overlap_counts": overlap_counts,
+            "iou": iou_from_counts(overlap_counts)[:, :num_zones],
+            "pirads": np.array(mri_dicts[reader][pid], dtype=float),
+        }
+
+    features = {
+        "readers": reader_features,
+        "tpm": tpm,
+        "half_ratio_dict": {},
+        "quarter_ratio_dict": {},
+    }
+    if tpm is None or localised_level == 20:
+        return features
+
+    # Barzell x current level gland voxel counts on the cells cut by both box sets
+    barzell_lim = get_zone_lim(zone_config, 20, geometry['bbox'])
+    joint_edges = [np.union1d(a, b) for a, b in zip(zone_edges(barzell_lim, geometry['lo'], geometry['hi']), edges)]
+    joint_lut = edges_lut(barzell_lim, joint_edges).astype(np.intp) * (num_zones + 1) + edges_lut(zone_lim, joint_edges)
+    bar_zone_counts = label_counts(joint_lut, geometry['gland'], geometry['lo'], joint_edges, len(barzell_lim) * (num_zones + 1))
+    bar_zone_counts = bar_zone_counts.reshape(len(barzell_lim), num_zones + 1)
+
+    half_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["half_map"].items()}
+    features["half_ratio_dict"] = calculate_ratio_from_counts(tpm_zone_map_config["half_map"], bar_zone_counts, half_ratio_dict)
+    if localised_level == 8:
+        quarter_ratio_dict = {k:{v:None for v in vs} for k,vs in tpm_zone_map_config["quarter_map"].items()}
+        features["quarter_ratio_dict"] = calculate_ratio_from_counts(tpm_zone_map_config["quarter_map"], bar_zone_counts, quarter_ratio_dict)
+    return features
+
+
+def run_zone_config_sweep(localised_levels, zone_config_grid=zone_sweep_grid, base_config_name=zone_sweep_base_config):
+    """
+    Evaluates every candidate zone configuration of the grid without writing zone masks.
+
+    Each patient is loaded once per level, and every candidate is labelled in memory from its
+    geometry. In 'sample' and 'exact' sampling modes a candidate equal to a zone_config.yml set
+    gives the results of localised_analysis.py for that set. Every candidate restarts the 'legacy'
+    random stream, whereas localised_analysis.py seeds it once per level and continues it over
+    current_zone_configs, so in 'legacy' mode this only holds for the first of current_zone_configs.
+    Writes one Excel file per level with the candidate parameters in front of the usual columns.
+    """
+    with open('zone_config.yml', 'r') as f:
+        zone_config = yaml.safe_load(f)
+    candidates = zone_config_candidates(zone_config[base_config_name], zone_config_grid)
+
+    patient_ids = load_patient_ids()
+    mri_dicts = load_mri_reports(patient_ids)
+    tpm_cancer, tpm_zone_wc = get_tpm_cancer_tensor(patient_ids, total_cancer_defs, load_rules())
+    patient_index = {pid: p for p, pid in enumerate(patient_ids)}
+
+    for localised_level in localised_levels:
+        print(f"\n--- Sweeping {len(candidates)} zone configurations for {localised_level}-Zone Level ---")
+        num_zones, zone_level_filename_part, tpm_zone_map_config = get_level_config(localised_level)
+
+        candidate_features = [{} for _ in candidates]
+        with PatientStream() as stream:
+            patient_stream = stream.stream(patient_ids, lambda pid: (load_patient_geometry(pid), load_tpm_data(pid)), num_volumes=1)
+            for pid, (geometry, tpm) in tqdm.tqdm(patient_stream, total=len(patient_ids), desc="    Patients"):
+                if geometry is None:
+                    count_event('skip_patient', pid=pid, reason='missing T2 image or gland mask')
+                    continue
+                with span('zone_sweep_features', pid=pid):
+                    for patient_features, (_, _, config) in zip(candidate_features, candidates):
+                        patient_features[pid] = zone_sweep_features(pid, geometry, config, localised_level, num_zones, mri_dicts, tpm, tpm_zone_map_config)
+
+        log_dict_array_for_current_file = []
+        for patient_features, (name, params, _) in tqdm.tqdm(list(zip(candidate_features, candidates)), desc="    Configs"):
+            random.seed(42)
+            if sampling_mode != 'legacy':
+                for pid, features in patient_features.items():
+                    if features["tpm"] is not None:
+                        features["tpm_zones"] = get_patient_tpm_zones(pid, features, localised_level, num_zones, tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index)
+            for pirads_thre in pirads_thresholds:
+                for iou_thre in iou_thresholds:
+                    mri_les_dict_all_patients, tpm_les_dict_all_patients = collect_patient_rows(patient_features, pirads_thre, iou_thre, localised_level, num_zones,
+                                                                                                tpm_zone_map_config, tpm_cancer, tpm_zone_wc, patient_index)
+                    for reader, cancer_def in itertools.product(readers, total_cancer_defs):
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            log_dict = evaluate_definition(cancer_def, pirads_thre, iou_thre, mri_les_dict_all_patients[reader], tpm_les_dict_all_patients[cancer_def], localised_level, num_zones)
+                        log_dict = reader_log_dict(reader, log_dict)
+                        if log_dict is not None:
+                            log_dict_array_for_current_file.append(dict({"zone_config": name}, **{key: str(value) for key, value in params.items()}, **log_dict))
+            # sampled rows are only needed for this candidate
+            for features in patient_features.values():
+                features.pop("tpm_zones", None)
+
+        df = pd.DataFrame(log_dict_array_for_current_file)
+        filename = f"{zone_level_filename_part}_0_{base_config_name}_zone_sweep.xlsx"
+        with span('excel_export'):
+            df.to_excel(filename, index=False)
+        print(f"Saved results to {filename}")
+
+
+if __name__ == "__main__":
+    localised_levels_to_run = [20, 8, 4, 2]
+    run_zone_config_sweep(localised_levels_to_run)
+    write_trace()